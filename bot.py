@@ -7,18 +7,38 @@ import time as time_module  # 重命名 time 模块
 import random
 import re
 from datetime import datetime, timedelta, time, timezone
-from typing import Dict, List, Any, Optional
-from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Any, Optional
+from contextlib import asynccontextmanager, contextmanager
+import contextvars
+from functools import wraps, lru_cache
 import csv
 import io
 import uuid
+import sys
+import threading
+import collections
+import traceback
+import heapq
+import gzip
+import tempfile
+import bisect
+import unicodedata
+from array import array
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+import numpy as np
 
 import pytz
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember, ChatPermissions
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ChatMemberHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember, ChatPermissions, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ChatMemberHandler, InlineQueryHandler, ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+from telegram.error import RetryAfter
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from bs4 import BeautifulSoup
@@ -27,6 +47,7 @@ import google.generativeai as genai
 from dotenv import load_dotenv
 import uvicorn
 from io import BytesIO
+from openpyxl import Workbook
 
 # 加载环境变量
 load_dotenv()
@@ -42,6 +63,256 @@ logger = logging.getLogger(__name__)
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Prometheus 指标
+HANDLER_LATENCY = Histogram(
+    "bot_handler_latency_seconds", "处理器耗时", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "处理器未捕获异常次数", ["handler"]
+)
+UPDATES_TOTAL = Counter(
+    "bot_updates_total", "收到的 Telegram 更新数", ["status"]
+)
+SHEETS_CALLS = Counter(
+    "bot_sheets_calls_total", "Google Sheets 调用次数", ["method", "outcome"]
+)
+SHEETS_LATENCY = Histogram(
+    "bot_sheets_call_latency_seconds", "Google Sheets 调用耗时", ["method"]
+)
+GEMINI_LATENCY = Histogram(
+    "bot_gemini_latency_seconds", "Gemini 生成耗时"
+)
+GEMINI_ERRORS = Counter(
+    "bot_gemini_errors_total", "Gemini 调用失败次数"
+)
+TELEGRAM_API_CALLS = Counter(
+    "bot_telegram_api_calls_total", "Bot API 调用次数", ["method", "status"]
+)
+TELEGRAM_RATE_LIMITED = Counter(
+    "bot_telegram_rate_limited_total", "Bot API 返回 429 的次数", ["method"]
+)
+BACKGROUND_TASKS = Gauge(
+    "bot_background_tasks", "等待中的后台任务数", ["kind"]
+)
+FLOOD_DETECTIONS = Counter(
+    "bot_flood_detections_total", "检测到刷屏的次数"
+)
+FLOOD_TRACKED_USERS = Gauge(
+    "bot_flood_tracked_users", "刷屏检测中跟踪的 (群组, 用户) 数"
+)
+DUPLICATE_CLUSTERS = Counter(
+    "bot_duplicate_clusters_total", "检测到的相似消息群数"
+)
+JOIN_LOCKDOWNS = Counter(
+    "bot_join_lockdowns_total", "加群突增触发防护模式的次数"
+)
+SPAM_MATCHES = Counter(
+    "bot_spam_matches_total", "命中垃圾消息规则的次数", ["action"]
+)
+KEYWORD_REPLIES = Counter(
+    "bot_keyword_replies_total", "关键词自动回复触发次数", ["outcome"]
+)
+RECORD_QUEUE_SIZE = Gauge(
+    "bot_record_queue_size", "等待写入 Google Sheets 的封禁记录数"
+)
+LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds", "事件循环调度延迟",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+LOOP_BLOCKS = Counter(
+    "bot_event_loop_blocked_total", "事件循环被阻塞超过阈值的次数", ["handler"]
+)
+CPU_JOBS = Counter(
+    "bot_cpu_jobs_total", "进程池任务数", ["job", "outcome"]
+)
+CPU_JOBS_PENDING = Gauge(
+    "bot_cpu_jobs_pending", "已提交但未完成的进程池任务数"
+)
+CPU_JOB_WAIT = Histogram(
+    "bot_cpu_job_wait_seconds", "进程池任务排队等待时间", ["job"]
+)
+CPU_JOB_DURATION = Histogram(
+    "bot_cpu_job_duration_seconds", "进程池任务执行时间", ["job"]
+)
+
+# 进程内追踪
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """一次计时操作，子 span 继承父 span 的 trace_id"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start", "end", "error")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.start = time_module.time_ns()
+        self.end = None
+        self.error = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "attributes": self.attributes,
+            "start": self.start,
+            "duration_ms": round((self.end - self.start) / 1e6, 3) if self.end else None,
+            "error": self.error,
+        }
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+
+class Tracer:
+    """保存最近的追踪记录，并可选地以 OTLP/HTTP JSON 导出到本地收集器"""
+    def __init__(self, max_traces: int = 200):
+        self.traces = collections.OrderedDict()  # trace_id -> [Span]
+        self.max_traces = max_traces
+        self.export_queue = collections.deque(maxlen=10000)
+        self.otlp_endpoint = None
+        self._exporter = None
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = current_span.get()
+        span = Span(name, parent, attributes)
+        if parent is None:
+            self.traces[span.trace_id] = []
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end = time_module.time_ns()
+            spans = self.traces.get(span.trace_id)
+            if spans is not None:
+                spans.append(span)
+            if self.otlp_endpoint:
+                self.export_queue.append(span)
+
+    def recent(self, limit: int = 20, min_ms: float = 0) -> List[Dict[str, Any]]:
+        """最近完成的追踪，按时间倒序"""
+        result = []
+        for trace_id in reversed(self.traces):
+            spans = self.traces[trace_id]
+            root = next((span for span in spans if span.parent_id is None), None)
+            if root is None:
+                continue  # 根 span 尚未结束
+            duration_ms = (root.end - root.start) / 1e6
+            if duration_ms < min_ms:
+                continue
+            result.append({
+                "trace_id": trace_id,
+                "name": root.name,
+                "duration_ms": round(duration_ms, 3),
+                "spans": [span.to_dict() for span in sorted(spans, key=lambda s: s.start)],
+            })
+            if len(result) >= limit:
+                break
+        return result
+
+    def start_exporter(self, endpoint: str, interval: float = 5) -> None:
+        self.otlp_endpoint = endpoint
+        self._exporter = spawn_background(self._export_loop(interval), "otlp_exporter")
+
+    def stop_exporter(self) -> None:
+        if self._exporter:
+            self._exporter.cancel()
+
+    async def _export_loop(self, interval: float) -> None:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                await asyncio.sleep(interval)
+                spans = []
+                while self.export_queue and len(spans) < 1000:
+                    spans.append(self.export_queue.popleft())
+                if not spans:
+                    continue
+                payload = {"resourceSpans": [{
+                    "resource": {"attributes": [
+                        {"key": "service.name", "value": {"stringValue": "banlogger_bot"}}
+                    ]},
+                    "scopeSpans": [{
+                        "scope": {"name": "bot"},
+                        "spans": [span.to_otlp() for span in spans],
+                    }],
+                }]}
+                try:
+                    async with session.post(self.otlp_endpoint, json=payload) as resp:
+                        if resp.status >= 400:
+                            logger.warning(f"导出追踪数据失败: HTTP {resp.status}")
+                except Exception as e:
+                    logger.warning(f"导出追踪数据失败: {e}")
+
+tracer = Tracer()
+
+class MeteredSheets:
+    """为 gspread 对象统计调用次数和耗时的代理"""
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if isinstance(attr, (gspread.Spreadsheet, gspread.Worksheet)):
+            return MeteredSheets(attr)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            start = time_module.perf_counter()
+            try:
+                with tracer.span(f"sheets.{name}"):
+                    result = attr(*args, **kwargs)
+            except Exception:
+                SHEETS_CALLS.labels(method=name, outcome="error").inc()
+                raise
+            finally:
+                SHEETS_LATENCY.labels(method=name).observe(time_module.perf_counter() - start)
+            SHEETS_CALLS.labels(method=name, outcome="ok").inc()
+            if isinstance(result, (gspread.Spreadsheet, gspread.Worksheet)):
+                return MeteredSheets(result)
+            return result
+        return call
+
+class MeteredRequest(HTTPXRequest):
+    """统计 Bot API 调用结果（包括 429 限流）的请求类"""
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        try:
+            with tracer.span(f"telegram.{api_method}") as span:
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+                span.attributes["status"] = code
+        except Exception:
+            TELEGRAM_API_CALLS.labels(method=api_method, status="error").inc()
+            raise
+        TELEGRAM_API_CALLS.labels(method=api_method, status=str(code)).inc()
+        if code == 429:
+            TELEGRAM_RATE_LIMITED.labels(method=api_method).inc()
+        return code, payload
+
 class GoogleSheetsStorage:
     """Google Sheets 存储类"""
     def __init__(self):
@@ -73,7 +344,7 @@ class GoogleSheetsStorage:
             )
             
             # 创建客户端
-            self.client = gspread.authorize(self.credentials)
+            self.client = MeteredSheets(gspread.authorize(self.credentials))
             
             # 尝试打开或创建封禁记录表
             try:
@@ -461,22 +732,43 @@ class GoogleSheetsStorage:
             
         try:
             # 添加新记录
-            self.ban_sheet.append_row([
-                record.get("操作时间", ""),
-                record.get("电报群组名称", ""),
-                record.get("用户ID", ""),
-                record.get("用户名", ""),
-                record.get("名称", ""),
-                record.get("操作管理", ""),
-                record.get("理由", ""),
-                record.get("操作", "")
-            ])
+            self.ban_sheet.append_row(self._record_row(record))
             return True
             
         except Exception as e:
             logger.error(f"保存封禁记录失败: {e}")
             return False
 
+    async def save_records_to_sheet(self, records: List[Dict[str, str]]) -> bool:
+        """批量保存封禁记录，一次请求写入所有行"""
+        if not records:
+            return True
+        if not self.initialized:
+            await self.initialize()
+            
+        try:
+            rows = [self._record_row(record) for record in records]
+            await asyncio.to_thread(self.ban_sheet.append_rows, rows)
+            return True
+            
+        except Exception as e:
+            logger.error(f"批量保存封禁记录失败: {e}")
+            return False
+
+    @staticmethod
+    def _record_row(record: Dict[str, str]) -> List[Any]:
+        """按表头顺序排列记录字段"""
+        return [
+            record.get("操作时间", ""),
+            record.get("电报群组名称", ""),
+            record.get("用户ID", ""),
+            record.get("用户名", ""),
+            record.get("名称", ""),
+            record.get("操作管理", ""),
+            record.get("理由", ""),
+            record.get("操作", "")
+        ]
+
     def get_sheet_url(self):
         """获取表格链接"""
         if not self.reminder_sheet:
@@ -531,7 +823,41 @@ WEBHOOK_PATH = "/telegram"
 WEBHOOK_URL = f"{os.getenv('RENDER_EXTERNAL_URL', '')}{WEBHOOK_PATH}" if os.getenv("RENDER_EXTERNAL_URL") else None
 TIMEZONE = pytz.timezone('Asia/Shanghai')  # 设置为北京时间
 MAX_RECORDS_DISPLAY = 10
+MAX_CURSOR_RESULTS = 1000  # 分页查询最多保留的结果数
+CURSOR_TTL = int(os.getenv("CURSOR_TTL", "300"))  # 分页游标的有效期（秒）
+BAN_CONCURRENCY = int(os.getenv("BAN_CONCURRENCY", "10"))  # 并发执行 Bot API 封禁调用的上限
+RAID_WINDOW = int(os.getenv("RAID_WINDOW", "600"))  # 批量封禁时回溯相同消息的时间窗口（秒）
+RECENT_MESSAGES_PER_CHAT = 500  # 每个群组保留的最近消息数
+SPAM_PATTERNS_FILE = os.getenv("SPAM_PATTERNS_FILE", "spam_patterns.txt")  # 垃圾消息规则文件
+FAILED_RECORDS_FILE = os.getenv("FAILED_RECORDS_FILE", "failed_records.jsonl")  # 写入 Google Sheets 失败的记录，下次启动时重新写入
+SPAM_MUTE_DURATION = os.getenv("SPAM_MUTE_DURATION", "1d")  # 规则动作为 mute 时的禁言时长
+FLOOD_MAX_MESSAGES = int(os.getenv("FLOOD_MAX_MESSAGES", "6"))  # 时间窗口内允许的最多消息数
+FLOOD_WINDOW = float(os.getenv("FLOOD_WINDOW", "10"))  # 刷屏检测时间窗口（秒）
+FLOOD_MUTE_DURATION = os.getenv("FLOOD_MUTE_DURATION", "10m")  # 刷屏自动禁言时长
+DUP_WINDOW = float(os.getenv("DUP_WINDOW", "600"))  # 相似消息检测时间窗口（秒）
+DUP_MIN_USERS = int(os.getenv("DUP_MIN_USERS", "3"))  # 达到该数量的不同用户发送相似消息时提醒管理员
+DUP_SIMILARITY = float(os.getenv("DUP_SIMILARITY", "0.6"))  # 视为相似消息的 Jaccard 相似度阈值
+JOIN_BURST = int(os.getenv("JOIN_BURST", "10"))  # 时间窗口内加入人数达到该值时开启防护模式
+JOIN_WINDOW = float(os.getenv("JOIN_WINDOW", "60"))  # 加群突增检测时间窗口（秒）
+LOCKDOWN_DURATION = float(os.getenv("LOCKDOWN_DURATION", "600"))  # 最后一次加入后防护模式持续时间（秒）
+MUTE_EXPIRY_NOTIFY = os.getenv("MUTE_EXPIRY_NOTIFY", "").lower() in ("1", "true", "yes")  # 禁言到期时在群组内通知
+FEDERATED_CHAT_IDS = [int(id) for id in os.getenv("FEDERATED_CHAT_IDS", "").split(",") if id]  # 受信任的联邦群组ID，只有在这些群组中的封禁会同步到其他群组
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")  # 调试接口的访问令牌
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # 事件循环延迟采样间隔（秒）
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))  # 超过该延迟时记录阻塞调用栈（秒）
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT")  # 例如 http://localhost:4318/v1/traces
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(max(1, min(4, (os.cpu_count() or 2) - 1)))))  # CPU 密集任务的进程数
+CPU_JOB_TIMEOUT = float(os.getenv("CPU_JOB_TIMEOUT", "300"))  # 进程池任务的默认超时（秒）
+KEYWORD_COOLDOWN = float(os.getenv("KEYWORD_COOLDOWN", "60"))  # 同一群组同一关键词两次自动回复的最小间隔（秒）
+KEYWORD_THREAD_TTL = float(os.getenv("KEYWORD_THREAD_TTL", "3600"))  # 同一话题内同一关键词只回复一次的有效期（秒）
+KEYWORD_COALESCE_WINDOW = float(os.getenv("KEYWORD_COALESCE_WINDOW", "1"))  # 合并同时触发的等待时间（秒）
+KEYWORD_MENU_PAGE = 8  # 关键词管理菜单每页的关键词数
+INLINE_RESULTS_LIMIT = 20  # 内联查询每次返回的关键词数（Telegram 上限 50）
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))  # Telegram 缓存内联查询结果的时间（秒）
 EXCEL_FILE = "ban_records.xlsx"
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_BYTES", str(45 * 1024 * 1024)))  # 单个导出文件的上限（Telegram 机器人上传上限为 50MB）
+EXPORT_GZIP_ROWS = int(os.getenv("EXPORT_GZIP_ROWS", "20000"))  # 超过该行数的 CSV 导出使用 gzip 压缩
+EXPORT_XLSX_ROWS = 500000  # 每个 XLSX 文件的最大行数（Excel 单表上限约 104 万行）
 
 # 全局变量
 ADMIN_USER_IDS = [int(id) for id in os.getenv("ADMIN_USER_IDS", "").split(",") if id]  # 管理员用户ID列表
@@ -539,7 +865,6 @@ TARGET_GROUP_ID = 1002444909093  # 目标群组ID
 MONITORED_BOT_IDS = [7039829949]  # 要监听的机器人ID列表
 bot_app = None
 bot_initialized = False
-ban_records = []
 reply_keywords = {}
 sheets_storage = GoogleSheetsStorage()  # 创建 GoogleSheetsStorage 实例
 # 在全局变量部分添加
@@ -550,6 +875,10 @@ mystonks_reminder_enabled = False  # MyStonks 提醒开关
 # 在文件开头的全局变量部分添加
 ai_enabled = False  # 默认关闭AI功能
 ai_conversations = {}  # 存储对话历史
+recent_messages = {}  # 群组ID -> 最近消息 deque，用于批量封禁等功能
+federation_enabled = os.getenv("FEDERATION_ENABLED", "").lower() in ("1", "true", "yes")  # 联邦封禁开关
+managed_chats = {chat_id: "" for chat_id in FEDERATED_CHAT_IDS}  # 机器人担任管理员的群组ID -> 群组名称
+federated_banned_ids = set()  # 联邦封禁名单（所有受管群组共享）
 
 app = FastAPI()
 
@@ -575,6 +904,1419 @@ async def check_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> boo
         logger.error(f"Error checking admin status: {e}")
         return False
 
+background_tasks = set()  # 持有后台任务的引用，防止被垃圾回收
+
+def spawn_background(coro, kind: str = "other") -> asyncio.Task:
+    """创建后台任务并统计等待中的数量"""
+    task = asyncio.create_task(coro, name=kind)
+    background_tasks.add(task)
+    BACKGROUND_TASKS.labels(kind=kind).inc()
+
+    def _done(t):
+        background_tasks.discard(t)
+        BACKGROUND_TASKS.labels(kind=kind).dec()
+
+    task.add_done_callback(_done)
+    return task
+
+handler_names = set()  # 已注册的处理器函数名，用于从调用栈中识别处理器
+
+def track_handler(callback):
+    """包装处理器，记录耗时和未捕获的异常"""
+    name = callback.__name__
+    handler_names.add(name)
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        stop = None
+        with HANDLER_LATENCY.labels(handler=name).time(), tracer.span(f"handler.{name}"):
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop as e:
+                stop = e  # 正常结束后续处理，不计为错误
+            except Exception:
+                HANDLER_ERRORS.labels(handler=name).inc()
+                raise
+        raise stop
+    return wrapper
+
+class LoopWatchdog:
+    """事件循环延迟监控，循环被阻塞时抓取阻塞代码的调用栈"""
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time_module.monotonic()
+        self.loop_thread_id = None
+        self.blocked_stack = None
+        self.blocked_handler = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time_module.monotonic()
+        self._stop.clear()
+        self._task = spawn_background(self._tick(), "loop_watchdog")
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _tick(self) -> None:
+        """在事件循环中定期休眠，实际唤醒时间与预期之差即为延迟"""
+        while True:
+            expected = time_module.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time_module.monotonic() - expected, 0)
+            self.heartbeat = time_module.monotonic()
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                handler = self.blocked_handler or "unknown"
+                LOOP_BLOCKS.labels(handler=handler).inc()
+                logger.warning(
+                    f"事件循环被阻塞 {lag:.3f} 秒 (处理器: {handler})\n"
+                    f"{self.blocked_stack or '未能抓取调用栈'}"
+                )
+            self.blocked_stack = None
+            self.blocked_handler = None
+
+    def _watch(self) -> None:
+        """独立线程：心跳超时时抓取事件循环线程的调用栈"""
+        while not self._stop.wait(self.threshold / 2):
+            stalled = time_module.monotonic() - self.heartbeat - self.interval
+            if stalled < self.threshold or self.blocked_stack is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            self.blocked_handler = self._find_handler(frame)
+            self.blocked_stack = "".join(traceback.format_stack(frame))
+
+    @staticmethod
+    def _find_handler(frame) -> Optional[str]:
+        while frame is not None:
+            if frame.f_code.co_name in handler_names:
+                return frame.f_code.co_name
+            frame = frame.f_back
+        return None
+
+loop_watchdog = LoopWatchdog()
+
+def _timed_call(func, args: tuple) -> tuple:
+    """在工作进程中执行任务，同时返回开始和结束时间，用于统计排队和执行耗时"""
+    started = time_module.time()
+    result = func(*args)
+    return result, started, time_module.time()
+
+class CpuPool:
+    """共享进程池，执行排行榜文本解析等 CPU 密集任务，避免阻塞事件循环
+
+    任务函数和参数都必须可以被 pickle（模块顶层函数）。使用 spawn 方式创建工作进程，
+    不会复制主进程中的线程和事件循环。超时只会让调用方停止等待，已在运行的任务会继续执行完。
+    """
+    def __init__(self, workers: int = CPU_WORKERS):
+        self.workers = workers
+        self.executor = None
+
+    def start(self) -> None:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def stop(self) -> None:
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args, timeout: float = CPU_JOB_TIMEOUT) -> Any:
+        self.start()
+        job = func.__name__
+        submitted = time_module.time()
+        CPU_JOBS_PENDING.inc()
+        future = self.executor.submit(_timed_call, func, args)
+        future.add_done_callback(lambda _: CPU_JOBS_PENDING.dec())
+        try:
+            with tracer.span(f"cpu.{job}"):
+                result, started, finished = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            future.cancel()  # 尚未开始的任务可以取消
+            CPU_JOBS.labels(job=job, outcome="timeout").inc()
+            logger.error(f"进程池任务 {job} 超过 {timeout:g} 秒未完成")
+            raise
+        except BrokenProcessPool:
+            CPU_JOBS.labels(job=job, outcome="error").inc()
+            self.executor = None  # 工作进程异常退出，下次提交时重建进程池
+            raise
+        except Exception:
+            CPU_JOBS.labels(job=job, outcome="error").inc()
+            raise
+        CPU_JOBS.labels(job=job, outcome="ok").inc()
+        CPU_JOB_WAIT.labels(job=job).observe(max(started - submitted, 0))
+        CPU_JOB_DURATION.labels(job=job).observe(finished - started)
+        return result
+
+cpu_pool = CpuPool()
+
+async def run_cpu_job(func, *args, timeout: float = CPU_JOB_TIMEOUT) -> Any:
+    """在共享进程池中执行 func(*args) 并等待结果"""
+    return await cpu_pool.run(func, *args, timeout=timeout)
+
+class RecordWriter:
+    """后台批量写入封禁记录，处理器只需入队，不等待 Google Sheets
+
+    停止时放入结束标记并等待写入任务把之前入队的记录全部写完；重试后仍失败的记录追加到
+    FAILED_RECORDS_FILE，下次启动时重新入队。
+    """
+    _STOP = object()  # 结束标记
+
+    def __init__(self, batch_size: int = 100, linger: float = 1.0, retries: int = 3, failed_path: str = FAILED_RECORDS_FILE):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.retries = retries
+        self.failed_path = failed_path
+        self.queue = asyncio.Queue()
+        self._task = None
+        self._stopping = False
+
+    def start(self) -> None:
+        self._stopping = False
+        self._load_failed()
+        self._task = spawn_background(self._run(), "record_writer")
+
+    async def stop(self) -> None:
+        """停止写入任务，等待队列中剩余的记录写完"""
+        if not self._task:
+            return
+        self._stopping = True
+        self.queue.put_nowait(self._STOP)
+        try:
+            await self._task
+        except Exception as e:
+            logger.error(f"封禁记录写入任务异常退出: {e}")
+        self._task = None
+        remaining = [record for record in self._drain() if record is not self._STOP]
+        if remaining:
+            self._save_failed(remaining)
+
+    def enqueue(self, *records: Dict[str, Any]) -> None:
+        for record in records:
+            self.queue.put_nowait(record)
+        RECORD_QUEUE_SIZE.set(self.queue.qsize())
+
+    def _drain(self) -> List[Any]:
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # 收到第一条记录后，最多等待 linger 秒凑成一批
+            record = await self.queue.get()
+            if record is self._STOP:
+                return
+            batch = [record]
+            stopping = False
+            deadline = loop.time() + self.linger
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is self._STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            RECORD_QUEUE_SIZE.set(self.queue.qsize())
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch: List[Dict[str, Any]]) -> None:
+        for attempt in range(self.retries):
+            try:
+                if await sheets_storage.save_records_to_sheet(batch):
+                    return
+            except Exception as e:
+                logger.error(f"写入封禁记录出错: {e}")
+            if self._stopping:
+                break  # 停止时不再等待重试，直接保存到文件
+            await asyncio.sleep(2 ** attempt)
+        self._save_failed(batch)
+
+    def _save_failed(self, records: List[Dict[str, Any]]) -> None:
+        """保存写入失败的记录，保存也失败时记录到日志"""
+        try:
+            with open(self.failed_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            logger.error(f"写入 {len(records)} 条封禁记录失败，已保存到 {self.failed_path}")
+        except OSError as e:
+            logger.error(f"写入 {len(records)} 条封禁记录失败且无法保存 ({e}): {records}")
+
+    def _load_failed(self) -> None:
+        """重新入队上次保存的失败记录"""
+        try:
+            with open(self.failed_path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"读取失败记录文件出错: {e}")
+            return
+        self.enqueue(*records)
+        os.remove(self.failed_path)  # 再次失败时会重新保存
+        logger.info(f"重新写入上次失败的 {len(records)} 条封禁记录")
+
+record_writer = RecordWriter()
+
+DURATION_UNITS = {
+    "w": 604800, "周": 604800,
+    "d": 86400, "天": 86400,
+    "h": 3600, "小时": 3600, "时": 3600,
+    "m": 60, "分钟": 60, "分": 60,
+    "s": 1, "秒": 1,
+}
+DURATION_PART = re.compile(r"(\d+)\s*(小时|分钟|[wdhms周天时分秒])", re.IGNORECASE)
+MAX_MUTE_DURATION = timedelta(days=366)  # Telegram 将超过366天的禁言视为永久
+MIN_MUTE_DURATION = timedelta(seconds=30)  # Telegram 将少于30秒的禁言同样视为永久
+
+def parse_duration(text: str) -> Optional[timedelta]:
+    """解析时长，例如 1d2h30m、90m、2小时30分钟；格式错误或为0时返回 None"""
+    text = text.strip()
+    if not text or DURATION_PART.sub("", text).strip():
+        return None  # 有无法识别的部分
+    seconds = sum(int(value) * DURATION_UNITS[unit.lower()] for value, unit in DURATION_PART.findall(text))
+    if seconds <= 0:
+        return None
+    return timedelta(seconds=seconds)
+
+def clamp_mute_duration(duration: timedelta) -> timedelta:
+    """将禁言时长限制在 Telegram 接受的范围内，避免被当作永久禁言"""
+    return min(max(duration, MIN_MUTE_DURATION), MAX_MUTE_DURATION)
+
+def format_duration(duration: timedelta) -> str:
+    """格式化时长为 1d2h30m 形式，可被 parse_duration 解析"""
+    seconds = int(duration.total_seconds())
+    parts = []
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60), ("s", 1)):
+        if seconds >= size:
+            parts.append(f"{seconds // size}{unit}")
+            seconds %= size
+    return "".join(parts) or "0s"
+
+def parse_record_time(value: str) -> Optional[datetime]:
+    """解析记录中的操作时间（北京时间）"""
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else TIMEZONE.localize(parsed)
+
+@lru_cache(maxsize=4096)
+def _utc_offset(day) -> float:
+    return TIMEZONE.localize(datetime.combine(day, datetime.min.time())).utcoffset().total_seconds()
+
+def record_timestamp(value: str) -> float:
+    """操作时间转为时间戳，解析失败时返回 0；按日期缓存时区偏移，比 parse_record_time 快得多"""
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return 0.0
+    if parsed.tzinfo:
+        return parsed.timestamp()
+    return (parsed - datetime(1970, 1, 1)).total_seconds() - _utc_offset(parsed.date())
+
+class BanRecord:
+    """一条封禁记录
+
+    字段存放在 __slots__ 中，时间戳预先解析；群组、管理员、理由、操作等重复出现的字符串由 RecordStore 共享同一对象。
+    兼容原来按表头读取的字典用法：record["理由"]、record.get("理由")。
+    """
+    __slots__ = ("ts", "time", "chat", "user_id", "username", "name", "operator", "reason", "action")
+    COLUMNS = {
+        "操作时间": "time",
+        "电报群组名称": "chat",
+        "用户ID": "user_id",
+        "用户名": "username",
+        "名称": "name",
+        "操作管理": "operator",
+        "理由": "reason",
+        "操作": "action",
+    }
+
+    def __init__(self, record: Dict[str, Any], intern=lambda value: value):
+        self.time = str(record.get("操作时间", ""))
+        self.ts = record_timestamp(self.time)
+        self.chat = intern(str(record.get("电报群组名称", "")))
+        user_id = record.get("用户ID", "")
+        self.user_id = int(user_id) if str(user_id).lstrip("-").isdigit() else str(user_id)
+        self.username = intern(str(record.get("用户名", "")))
+        self.name = str(record.get("名称", ""))
+        self.operator = intern(str(record.get("操作管理", "")))
+        self.reason = intern(str(record.get("理由", "")))
+        self.action = intern(str(record.get("操作", "")))
+
+    def __getitem__(self, column: str) -> Any:
+        return getattr(self, self.COLUMNS[column])
+
+    def get(self, column: str, default: Any = None) -> Any:
+        attr = self.COLUMNS.get(column)
+        return getattr(self, attr) if attr else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {column: getattr(self, attr) for column, attr in self.COLUMNS.items()}
+
+class RecordStore:
+    """内存中的封禁记录
+
+    记录ID 为追加顺序，稳定不变（索引中保存的就是它）；另维护按时间戳排序的 (时间戳, 记录ID) 数组，
+    最近 N 条和时间范围查询只需二分查找，复杂度 O(log n + k)。
+    """
+
+    def __init__(self):
+        self.records = []  # 记录ID -> BanRecord
+        self.order_ts = array("d")  # 按时间排序的时间戳
+        self.order_ids = array("I")  # 与 order_ts 对应的记录ID
+        self._strings = {}
+        self.version = getattr(self, "version", 0) + 1  # 内容变化时递增，用于缓存失效
+
+    def _intern(self, value: str) -> str:
+        return self._strings.setdefault(value, value)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, record_id: int) -> BanRecord:
+        return self.records[record_id]
+
+    def append(self, record: Dict[str, Any]) -> int:
+        """追加一条记录并返回记录ID；新记录通常最新，插入点在数组末尾"""
+        entry = BanRecord(record, self._intern)
+        record_id = len(self.records)
+        self.records.append(entry)
+        position = bisect.bisect_right(self.order_ts, entry.ts)
+        self.order_ts.insert(position, entry.ts)
+        self.order_ids.insert(position, record_id)
+        self.version += 1
+        return record_id
+
+    def load(self, records: List[Dict[str, Any]]) -> None:
+        """用从表格加载的记录替换全部内容"""
+        self.__init__()
+        self.records = [BanRecord(record, self._intern) for record in records]
+        order = sorted(range(len(self.records)), key=lambda record_id: self.records[record_id].ts)
+        self.order_ts = array("d", (self.records[record_id].ts for record_id in order))
+        self.order_ids = array("I", order)
+
+    def latest(self, limit: int) -> List[int]:
+        """最新的 limit 条记录ID，从新到旧"""
+        return self.order_ids[-limit:][::-1].tolist() if limit > 0 else []
+
+    def between(self, since: float, until: Optional[float] = None) -> List[int]:
+        """时间戳在 [since, until) 内的记录ID，从新到旧"""
+        start = bisect.bisect_left(self.order_ts, since)
+        end = len(self.order_ts) if until is None else bisect.bisect_left(self.order_ts, until)
+        return self.order_ids[start:end][::-1].tolist()
+
+ban_records = RecordStore()
+
+class RecordSearchIndex:
+    """封禁记录的倒排索引，支持中文子串查询
+
+    每个字段按不同取值分组（取值 -> 记录ID数组），再对不同取值建立字符一元、二元组倒排（字符组 -> 取值集合）。
+    查询时用二元组求交得到候选取值并逐个验证子串，群组、管理员、理由等低基数字段的索引很小；
+    命中取值的记录ID按从新到旧惰性合并，取够结果即停止。记录ID 即在 ban_records 中的下标。
+    """
+    FIELDS = {
+        "reason": "理由",
+        "name": "名称",
+        "username": "用户名",
+        "group": "电报群组名称",
+        "admin": "操作管理",
+    }
+    DEFAULT_FIELDS = ("reason", "name", "username", "group")
+    WEIGHTS = {"reason": 3, "name": 2, "username": 2, "group": 1, "admin": 1}
+
+    def __init__(self):
+        self.values = {field: {} for field in self.FIELDS}  # 字段 -> {小写取值: array('I') 记录ID}
+        self.grams = {field: {} for field in self.FIELDS}  # 字段 -> {字符组: 取值集合}
+        self.size = 0
+
+    @staticmethod
+    def _ngrams(text: str) -> set:
+        """一元和二元字符组；查询一个字时用一元组，更长的词只用二元组"""
+        return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+    @classmethod
+    def _value(cls, record: Dict[str, Any], field: str) -> str:
+        return str(record.get(cls.FIELDS[field], "") or "").lower()
+
+    def add(self, record_id: int, record: Dict[str, Any]) -> None:
+        """索引一条记录，record_id 必须递增"""
+        for field in self.FIELDS:
+            value = self._value(record, field)
+            if not value:
+                continue
+            ids = self.values[field].get(value)
+            if ids is None:
+                ids = self.values[field][value] = array("I")
+                for gram in self._ngrams(value):
+                    self.grams[field].setdefault(gram, set()).add(value)
+            ids.append(record_id)
+        self.size += 1
+
+    def rebuild(self, records: List[Dict[str, Any]]) -> None:
+        self.__init__()
+        for record_id, record in enumerate(records):
+            self.add(record_id, record)
+        logger.info(f"搜索索引已重建: {self.size} 条记录")
+
+    def _matching_values(self, field: str, term: str) -> List[str]:
+        """字段中包含 term 的所有不同取值"""
+        if len(term) < 2:
+            return list(self.grams[field].get(term, ()))
+        postings = [self.grams[field].get(term[i:i + 2]) for i in range(len(term) - 1)]
+        if not all(postings):
+            return []
+        postings.sort(key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [value for value in candidates if term in value]
+
+    @classmethod
+    def parse_query(cls, query: str) -> List[tuple]:
+        """解析查询为 [(字段元组, 词)]，支持 reason:广告 admin:张三 这样的字段过滤"""
+        terms = []
+        for token in query.lower().split():
+            field, sep, term = token.partition(":")
+            if sep and field in cls.FIELDS:
+                if term:
+                    terms.append(((field,), term))
+            else:
+                terms.append((cls.DEFAULT_FIELDS, token))
+        return terms
+
+    def search(self, query: str, records: List[Dict[str, Any]], limit: int = 1000) -> List[int]:
+        """返回匹配的记录ID，按相关度（命中字段权重，完全匹配加分）和时间从新到旧排序
+
+        所有词都必须命中；最多收集 limit 条最新的匹配后再排序。
+        """
+        terms = self.parse_query(query)
+        if not terms:
+            return []
+        # 以命中记录最少的词驱动遍历（各取值的记录ID从新到旧惰性合并），其余词直接在记录上验证
+        driver = None
+        for fields, term in terms:
+            arrays = [
+                self.values[field][value]
+                for field in fields
+                for value in self._matching_values(field, term)
+            ]
+            if not arrays:
+                return []
+            if driver is None or sum(map(len, arrays)) < sum(map(len, driver)):
+                driver = arrays
+        stream = heapq.merge(*(reversed(ids) for ids in driver), reverse=True)
+        
+        scored = []
+        last_id = None
+        for record_id in stream:
+            if record_id == last_id:
+                continue  # 同一记录在多个字段命中
+            last_id = record_id
+            record = records[record_id]
+            score = 0
+            for fields, term in terms:
+                best = 0
+                for field in fields:
+                    value = self._value(record, field)
+                    if term in value:
+                        best = max(best, self.WEIGHTS[field] + (2 if value == term else 0))
+                if not best:
+                    break
+                score += best
+            else:
+                scored.append((score, record_id))
+                if len(scored) >= limit:
+                    break
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+        return [record_id for _, record_id in scored]
+
+record_index = RecordSearchIndex()
+
+class RecordLookup:
+    """封禁记录的哈希二级索引：用户ID、群组、操作管理、理由 -> 记录ID数组（从旧到新）"""
+    KEYS = {
+        "user": "用户ID",
+        "chat": "电报群组名称",
+        "admin": "操作管理",
+        "reason": "理由",
+    }
+
+    def __init__(self):
+        self.maps = {kind: {} for kind in self.KEYS}
+
+    @staticmethod
+    def normalize(value: Any) -> str:
+        return str(value if value is not None else "").strip().lower()
+
+    def add(self, record_id: int, record: Dict[str, Any]) -> None:
+        for kind, column in self.KEYS.items():
+            key = self.normalize(record.get(column))
+            if key:
+                self.maps[kind].setdefault(key, array("I")).append(record_id)
+
+    def rebuild(self, records: List[Dict[str, Any]]) -> None:
+        self.__init__()
+        for record_id, record in enumerate(records):
+            self.add(record_id, record)
+
+    def get(self, kind: str, value: Any) -> array:
+        return self.maps[kind].get(self.normalize(value), array("I"))
+
+    def find_keys(self, kind: str, text: str) -> List[str]:
+        """完全匹配优先，否则返回包含 text 的所有键"""
+        text = self.normalize(text)
+        if text in self.maps[kind]:
+            return [text]
+        return [key for key in self.maps[kind] if text in key]
+
+record_lookup = RecordLookup()
+
+def format_record(record: Dict[str, Any]) -> str:
+    """格式化单条记录用于消息展示"""
+    record_time = parse_record_time(record.get("操作时间", ""))
+    return (
+        f"🕒 {record_time.strftime('%Y-%m-%d %H:%M') if record_time else record.get('操作时间', '未知')}\n"
+        f"👤 用户: {record.get('名称', '未知')} "
+        f"(ID: {record.get('用户ID', '未知')}) "
+        f"[{record.get('用户名', '无')}]\n"
+        f"👮 管理员: {record.get('操作管理', '未知')}\n"
+        f"📝 原因: {record.get('理由', '未填写')}\n"
+        f"💬 群组: {record.get('电报群组名称', '未知')}\n"
+        f"🔧 操作: {record.get('操作', '未知')}\n"
+        "━━━━━━━━━━━━━━\n"
+    )
+
+def newest_first(record_ids) -> List[int]:
+    """按操作时间从新到旧排列记录ID；从表格加载或联邦同步的记录追加顺序不一定是时间顺序"""
+    return sorted(record_ids, key=lambda record_id: (ban_records[record_id].ts, record_id), reverse=True)
+
+def summarize_actions(record_ids) -> str:
+    """按操作类型统计记录，例如 封禁 2 次、禁言 1 次"""
+    counts = collections.Counter(
+        ban_records[record_id].get("操作", "").split(" ")[0] or "未知" for record_id in record_ids
+    )
+    return "、".join(f"{action} {count} 次" for action, count in counts.most_common())
+
+class ModerationStats:
+    """增量维护的处理统计
+
+    按天保存 {维度: Counter[(取值, 操作)]}，维度为理由、管理员、群组；另有按天的操作计数。
+    新记录到来时直接累加，加载时用 pandas 分组一次性重建；查询只需合并窗口内各天的计数器。
+    """
+    DIMENSIONS = {"reason": "理由", "admin": "操作管理", "group": "电报群组名称"}
+
+    def __init__(self):
+        self.days = {}  # 日期 -> {"actions": Counter[操作], 维度: Counter[(取值, 操作)]}
+
+    @staticmethod
+    def action_of(record) -> str:
+        """操作类型，去掉禁言时长等附加信息"""
+        return str(record.get("操作", "")).split(" ")[0] or "未知"
+
+    def _day(self, day: str) -> Dict[str, collections.Counter]:
+        bucket = self.days.get(day)
+        if bucket is None:
+            bucket = self.days[day] = {"actions": collections.Counter()}
+            for dimension in self.DIMENSIONS:
+                bucket[dimension] = collections.Counter()
+        return bucket
+
+    def add(self, record: BanRecord) -> None:
+        if not record.ts:
+            return
+        bucket = self._day(datetime.fromtimestamp(record.ts, TIMEZONE).strftime("%Y-%m-%d"))
+        action = self.action_of(record)
+        bucket["actions"][action] += 1
+        for dimension, column in self.DIMENSIONS.items():
+            bucket[dimension][(record.get(column) or "未知", action)] += 1
+
+    def rebuild(self, records: RecordStore) -> None:
+        """用 pandas 对全部记录分组计数"""
+        self.days = {}
+        if not len(records):
+            return
+        df = pd.DataFrame({
+            "ts": [record.ts for record in records],
+            "action": [self.action_of(record) for record in records],
+            **{dimension: [record.get(column) or "未知" for record in records] for dimension, column in self.DIMENSIONS.items()},
+        })
+        df = df[df["ts"] > 0]
+        local = pd.to_datetime(df["ts"], unit="s", utc=True).dt.tz_convert(TIMEZONE.zone)
+        # 每天只格式化一次日期字符串
+        codes, uniques = pd.factorize(local.dt.normalize())
+        df["day"] = np.asarray(uniques.strftime("%Y-%m-%d"))[codes]
+        for (day, action), count in df.groupby(["day", "action"]).size().items():
+            self._day(day)["actions"][action] = int(count)
+        for dimension in self.DIMENSIONS:
+            for (day, key, action), count in df.groupby(["day", dimension, "action"]).size().items():
+                self.days[day][dimension][(key, action)] = int(count)
+        logger.info(f"处理统计已重建: {len(df)} 条记录，{len(self.days)} 天")
+
+    def _window(self, end: datetime, days: int) -> List[str]:
+        return [(end - timedelta(days=offset)).strftime("%Y-%m-%d") for offset in range(days)]
+
+    def summary(self, days: int = 7, top: int = 5) -> Dict[str, Any]:
+        """最近 days 天的统计，包括每日计数、各维度排行和与上一周期的对比"""
+        today = datetime.now(TIMEZONE)
+        current = self._window(today, days)
+        previous = self._window(today - timedelta(days=days), days)
+        empty = {"actions": collections.Counter(), **{dimension: collections.Counter() for dimension in self.DIMENSIONS}}
+        
+        totals = collections.Counter()
+        dimensions = {dimension: collections.Counter() for dimension in self.DIMENSIONS}
+        daily = {}
+        for day in current:
+            bucket = self.days.get(day, empty)
+            daily[day] = dict(bucket["actions"])
+            totals.update(bucket["actions"])
+            for dimension in self.DIMENSIONS:
+                for (key, _), count in bucket[dimension].items():
+                    dimensions[dimension][key] += count
+        previous_totals = collections.Counter()
+        for day in previous:
+            previous_totals.update(self.days.get(day, empty)["actions"])
+        
+        return {
+            "days": days,
+            "from": current[-1],
+            "to": current[0],
+            "totals": dict(totals),
+            "previous_totals": dict(previous_totals),
+            "daily": daily,
+            "top": {dimension: counter.most_common(top) for dimension, counter in dimensions.items()},
+        }
+
+moderation_stats = ModerationStats()
+
+class ModerationEvents:
+    """处理事件管道：所有处理路径都通过 publish 发布记录
+
+    记录先写入内存记录（分配记录ID），再按订阅顺序通知订阅者（后台写入、搜索索引、二级索引、统计），
+    各视图因此保持一致，无需重新加载。单个订阅者出错只记录日志，不影响其他订阅者。
+    """
+
+    def __init__(self, store: RecordStore):
+        self.store = store
+        self.subscribers = []
+
+    def subscribe(self, callback: Callable[[int, BanRecord], Any]) -> None:
+        """订阅新记录，回调参数为 (记录ID, 记录)"""
+        self.subscribers.append(callback)
+
+    def publish(self, *records: Dict[str, Any]) -> List[int]:
+        """发布新记录，返回分配的记录ID"""
+        record_ids = []
+        for record in records:
+            record_id = self.store.append(record)
+            record_ids.append(record_id)
+            entry = self.store[record_id]
+            for callback in self.subscribers:
+                try:
+                    callback(record_id, entry)
+                except Exception as e:
+                    logger.error(f"处理事件订阅者 {getattr(callback, '__qualname__', callback)} 出错: {e}")
+        return record_ids
+
+moderation_events = ModerationEvents(ban_records)
+moderation_events.subscribe(lambda record_id, record: record_writer.enqueue(record.to_dict()))
+moderation_events.subscribe(record_index.add)
+moderation_events.subscribe(record_lookup.add)
+moderation_events.subscribe(lambda record_id, record: moderation_stats.add(record))
+
+class QueryCursors:
+    """分页查询游标：缓存一次查询得到的记录ID，翻页时直接切片，不再重新查询
+
+    过期或超过数量上限时淘汰最旧的游标。
+    """
+
+    def __init__(self, ttl: float, max_cursors: int = 500):
+        self.ttl = ttl
+        self.max_cursors = max_cursors
+        self.cursors = collections.OrderedDict()  # 游标ID -> (过期时间, 标题, 记录ID数组)
+
+    def _expire(self, now: float) -> None:
+        while self.cursors:
+            cursor, (expires_at, _, _) = next(iter(self.cursors.items()))
+            if expires_at > now and len(self.cursors) <= self.max_cursors:
+                break
+            del self.cursors[cursor]
+
+    def create(self, header: str, record_ids) -> str:
+        now = time_module.monotonic()
+        cursor = uuid.uuid4().hex[:10]
+        self.cursors[cursor] = (now + self.ttl, header, array("I", record_ids[:MAX_CURSOR_RESULTS]))
+        self._expire(now)
+        return cursor
+
+    def get(self, cursor: str) -> Optional[tuple]:
+        """返回 (标题, 记录ID数组)，游标不存在或已过期时返回 None"""
+        self._expire(time_module.monotonic())
+        entry = self.cursors.get(cursor)
+        return entry[1:] if entry else None
+
+query_cursors = QueryCursors(CURSOR_TTL)
+
+def render_page(cursor: str, header: str, record_ids, page: int) -> tuple:
+    """渲染第 page 页（从0开始），返回 (文本, 翻页按钮)"""
+    pages = max(1, -(-len(record_ids) // MAX_RECORDS_DISPLAY))
+    page = min(max(page, 0), pages - 1)
+    start = page * MAX_RECORDS_DISPLAY
+    text = header + "".join(
+        format_record(ban_records[record_id]) for record_id in record_ids[start:start + MAX_RECORDS_DISPLAY]
+    )
+    if pages == 1:
+        return text, None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"page|{cursor}|{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="page|noop"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"page|{cursor}|{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons])
+
+async def reply_paginated(message, header: str, record_ids, delay: int = 60) -> None:
+    """以分页形式回复查询结果（记录ID需已按展示顺序排列）"""
+    cursor = query_cursors.create(header, record_ids)
+    text, reply_markup = render_page(cursor, header, record_ids, 0)
+    msg = await message.reply_text(text, reply_markup=reply_markup)
+    if reply_markup:
+        delay = max(delay, CURSOR_TTL)  # 可以翻页时保留到游标过期
+    spawn_background(delete_message_later(msg, delay=delay), "delete_message")
+
+class MuteIndex:
+    """当前生效的禁言，按到期时间排列的小顶堆，到期时记录日志并可选通知"""
+    def __init__(self):
+        self.heap = []  # (到期时间戳, 序号, 键)，过期条目延迟删除
+        self.active = {}  # (群组名称, 用户ID) -> 禁言信息
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._bot = None
+
+    def add(self, chat_title: str, user_id: int, expires_at: float, **info) -> None:
+        key = (chat_title, int(user_id))
+        self.active[key] = dict(info, chat_title=chat_title, user_id=int(user_id), expires_at=expires_at)
+        self._seq += 1
+        heapq.heappush(self.heap, (expires_at, self._seq, key))
+        if self.heap[0][2] == key:
+            self._wakeup.set()  # 新的禁言最早到期，重新计算等待时间
+
+    def remove(self, chat_title: str, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.active.pop((chat_title, int(user_id)), None)
+
+    def pop_expired(self, now: float) -> List[Dict[str, Any]]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(self.heap)
+            entry = self.active.get(key)
+            if entry and entry["expires_at"] == expires_at:
+                del self.active[key]
+                expired.append(entry)
+        return expired
+
+    def list(self, chat_title: Optional[str] = None) -> List[Dict[str, Any]]:
+        """当前生效的禁言，按到期时间排序"""
+        entries = [
+            entry for entry in self.active.values()
+            if chat_title is None or entry["chat_title"] == chat_title
+        ]
+        return sorted(entries, key=lambda entry: entry["expires_at"])
+
+    def rebuild(self, records: List[Dict[str, Any]]) -> None:
+        """按时间顺序回放封禁记录，恢复仍在生效的禁言"""
+        self.heap.clear()
+        self.active.clear()
+        now = time_module.time()
+        parsed = []
+        for record in records:
+            record_time = parse_record_time(record.get("操作时间", ""))
+            if record_time:
+                parsed.append((record_time, record))
+        parsed.sort(key=lambda item: item[0])
+        
+        titles = {title: chat_id for chat_id, title in managed_chats.items() if title}
+        for record_time, record in parsed:
+            operation = str(record.get("操作", ""))
+            chat_title = record.get("电报群组名称", "")
+            user_id = str(record.get("用户ID", ""))
+            if not user_id.lstrip("-").isdigit():
+                continue
+            if operation == "解除禁言":
+                self.remove(chat_title, int(user_id))
+            elif operation.startswith("禁言"):
+                duration = parse_duration(operation[len("禁言"):])
+                if not duration:
+                    continue
+                expires_at = record_time.timestamp() + duration.total_seconds()
+                if expires_at > now:
+                    self.add(
+                        chat_title, int(user_id), expires_at,
+                        chat_id=titles.get(chat_title),
+                        name=record.get("名称", ""),
+                        reason=record.get("理由", ""),
+                        operator=record.get("操作管理", ""),
+                    )
+        logger.info(f"恢复 {len(self.active)} 条生效中的禁言")
+
+    def start(self, bot) -> None:
+        self._bot = bot
+        self._task = spawn_background(self._run(), "mute_expiry")
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            timeout = self.heap[0][0] - time_module.time() if self.heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            for entry in self.pop_expired(time_module.time()):
+                logger.info(f"禁言到期: {entry.get('name')} ({entry['user_id']}) 于 {entry['chat_title']}")
+                if MUTE_EXPIRY_NOTIFY and entry.get("chat_id"):
+                    try:
+                        msg = await self._bot.send_message(
+                            chat_id=entry["chat_id"],
+                            text=f"🔔 用户 {entry.get('name') or entry['user_id']} 的禁言已到期"
+                        )
+                        spawn_background(delete_message_later(msg, delay=60), "delete_message")
+                    except Exception as e:
+                        logger.error(f"发送禁言到期通知失败: {e}")
+
+mute_index = MuteIndex()
+
+# 常见的形近字符（西里尔/希腊字母等）和繁体字，统一折叠后再匹配
+HOMOGLYPHS = str.maketrans({
+    "а": "a", "в": "b", "е": "e", "к": "k", "м": "m", "н": "h", "о": "o", "р": "p",
+    "с": "c", "т": "t", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ј": "j", "ԁ": "d",
+    "ɡ": "g", "ո": "n", "ս": "u", "α": "a", "β": "b", "ε": "e", "ι": "i", "κ": "k",
+    "ν": "v", "ο": "o", "ρ": "p", "τ": "t", "υ": "u", "χ": "x",
+    "廣": "广", "詐": "诈", "騙": "骗", "幣": "币", "號": "号", "聯": "联",
+    "繫": "系", "資": "资", "錢": "钱", "賺": "赚", "點": "点", "擊": "击", "會": "会",
+    "員": "员", "贈": "赠", "紅": "红", "優": "优", "碼": "码", "載": "载", "圖": "图",
+    "網": "网", "賬": "账", "帳": "账", "戶": "户", "證": "证", "現": "现", "幫": "帮",
+    "務": "务", "專": "专", "業": "业", "導": "导", "師": "师", "線": "线", "費": "费",
+    "發": "发", "貨": "货", "額": "额", "數": "数", "據": "据", "黃": "黄", "賭": "赌",
+    "場": "场", "體": "体", "驗": "验", "領": "领", "開": "开", "獎": "奖", "勵": "励",
+    "來": "来", "個": "个", "為": "为", "與": "与", "這": "这", "們": "们", "進": "进",
+    "請": "请", "約": "约", "訊": "讯", "鏈": "链", "價": "价", "財": "财", "項": "项", "簡": "简", "單": "单", "內": "内",
+})
+
+def normalize_text(text: str) -> str:
+    """规范化文本：全角转半角、统一大小写、折叠形近字，并去掉空白、标点、符号和零宽字符"""
+    text = unicodedata.normalize("NFKC", text).casefold().translate(HOMOGLYPHS)
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "ZPSC")
+
+class AhoCorasick:
+    """多模式匹配自动机，一次扫描找出文本中出现的所有模式"""
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.goto = [{}]  # 状态 -> {字符: 下一状态}
+        self.fail = [0]
+        self.out = [[]]  # 状态 -> 在此结束的模式下标（包括后缀链上的）
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+            if pattern:
+                self.out[state].append(index)
+        
+        # 广度优先计算失败指针
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(ch, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def search(self, text: str) -> set:
+        """返回文本中出现的模式下标集合"""
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+class SpamFilter:
+    """从规则文件加载垃圾消息规则，编译为自动机，文件修改后自动重新加载
+
+    每行一条规则：`模式`、`动作|模式` 或 `动作|理由|模式`，# 开头为注释。
+    动作为 delete、mute、ban、flag（默认 flag），理由默认为「广告」。
+    """
+    ACTIONS = ("flag", "delete", "mute", "ban")  # 按严重程度递增
+    
+    def __init__(self, path: str, check_interval: float = 10):
+        self.path = path
+        self.check_interval = check_interval
+        self.rules = []  # [(动作, 理由, 原始模式)]
+        self.matcher = None
+        self._mtime = None
+        self._last_check = 0
+
+    def load(self) -> int:
+        """加载并编译规则，返回规则数量；编译完成后整体替换，匹配不会看到半成品"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            self.rules, self.matcher, self._mtime = [], None, None
+            return 0
+        
+        rules = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split("|", 2)
+            if len(parts) == 3:
+                action, reason, pattern = parts
+            elif len(parts) == 2:
+                action, pattern = parts
+                reason = "广告"
+            else:
+                action, reason, pattern = "flag", "广告", parts[0]
+            action = action.strip().lower()
+            if action not in self.ACTIONS:
+                logger.warning(f"未知的垃圾消息规则动作: {line}")
+                continue
+            if normalize_text(pattern):
+                rules.append((action, reason.strip(), pattern.strip()))
+        
+        matcher = AhoCorasick([normalize_text(pattern) for _, _, pattern in rules])
+        self.rules, self.matcher, self._mtime = rules, matcher, mtime
+        logger.info(f"已加载 {len(rules)} 条垃圾消息规则")
+        return len(rules)
+
+    def maybe_reload(self) -> None:
+        """最多每 check_interval 秒检查一次文件修改时间"""
+        now = time_module.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.load()
+
+    def match(self, text: str) -> Optional[tuple]:
+        """返回命中规则中最严重的一条 (动作, 理由, 模式)"""
+        if not self.matcher or not text:
+            return None
+        found = self.matcher.search(normalize_text(text))
+        if not found:
+            return None
+        return max((self.rules[index] for index in found), key=lambda rule: self.ACTIONS.index(rule[0]))
+
+spam_filter = SpamFilter(SPAM_PATTERNS_FILE)
+
+class KeywordPrefixIndex:
+    """关键词前缀索引（字典树），用于内联查询自动补全
+
+    每个节点预先保存以该前缀开头的前 limit 个关键词（短的优先），查询只需沿前缀走到对应节点，
+    耗时只与输入长度有关，与关键词数量无关。
+    """
+    def __init__(self, keywords: List[str] = (), limit: int = INLINE_RESULTS_LIMIT):
+        self.root = ({}, [])  # (子节点: {字符: 节点}, 前 limit 个关键词)
+        normalized = [(normalize_text(keyword), keyword) for keyword in keywords]
+        for key, keyword in sorted(normalized, key=lambda item: (len(item[0]), item[0])):
+            node = self.root
+            if len(node[1]) < limit:
+                node[1].append(keyword)
+            for ch in key:
+                node = node[0].setdefault(ch, ({}, []))
+                if len(node[1]) < limit:
+                    node[1].append(keyword)
+
+    def lookup(self, prefix: str) -> List[str]:
+        node = self.root
+        for ch in normalize_text(prefix):
+            node = node[0].get(ch)
+            if node is None:
+                return []
+        return node[1]
+
+class KeywordReplyEngine:
+    """关键词自动回复引擎
+
+    关键词目录缓存在 reply_keywords 中，所有关键词（规范化后）编译为一个自动机，每条消息只扫描一次，
+    耗时只与消息长度有关，与关键词数量无关。目录变化时编译新的自动机后整体替换。
+    """
+    def __init__(self):
+        self.compiled = (None, [])  # (自动机, 模式下标 -> 关键词)，整体替换保证读取时一致
+        self.sorted_keywords = []  # 管理菜单使用的有序关键词列表
+        self.ids = {}  # 关键词 -> 短ID，用于回调数据，进程内稳定且不复用
+        self.keywords_by_id = {}
+        self.prefixes = KeywordPrefixIndex()  # 内联查询使用的前缀索引
+
+    def keyword_id(self, keyword: str) -> int:
+        keyword_id = self.ids.get(keyword)
+        if keyword_id is None:
+            keyword_id = self.ids[keyword] = len(self.ids) + 1
+            self.keywords_by_id[keyword_id] = keyword
+        return keyword_id
+
+    def keyword_for(self, keyword_id: str) -> Optional[str]:
+        """由短ID取回关键词，关键词已被删除时返回 None"""
+        keyword = self.keywords_by_id.get(int(keyword_id)) if keyword_id.isdigit() else None
+        return keyword if keyword in reply_keywords else None
+
+    def compile(self) -> None:
+        self.sorted_keywords = sorted(reply_keywords)
+        keywords = []
+        patterns = []
+        for keyword in self.sorted_keywords:
+            self.keyword_id(keyword)
+            pattern = normalize_text(keyword)
+            if pattern:
+                keywords.append(keyword)
+                patterns.append(pattern)
+        self.compiled = (AhoCorasick(patterns) if patterns else None, keywords)
+        self.prefixes = KeywordPrefixIndex(self.sorted_keywords)
+        logger.info(f"已编译 {len(patterns)} 个自动回复关键词")
+
+    async def reload(self) -> None:
+        """从 Google Sheets 重新加载关键词目录"""
+        replies = await sheets_storage.get_keyword_replies()
+        reply_keywords.clear()
+        reply_keywords.update((str(reply["关键词"]), reply) for reply in replies)
+        self.compile()
+
+    def set(self, reply: Dict[str, str]) -> None:
+        """添加或修改一个关键词并重新编译"""
+        reply_keywords[str(reply["关键词"])] = reply
+        self.compile()
+
+    def remove(self, keyword: str) -> None:
+        if reply_keywords.pop(keyword, None) is not None:
+            self.compile()
+
+    def match(self, text: str) -> Optional[Dict[str, str]]:
+        """返回消息中命中的最长关键词对应的回复配置"""
+        automaton, keywords = self.compiled
+        if automaton is None or not text:
+            return None
+        found = automaton.search(normalize_text(text))
+        if not found:
+            return None
+        best = max(found, key=lambda index: len(automaton.patterns[index]))
+        return reply_keywords.get(keywords[best])
+
+keyword_engine = KeywordReplyEngine()
+
+class KeywordReplyThrottle:
+    """关键词自动回复限流：同一群组同一关键词有冷却时间，同一话题（被回复的消息或论坛话题）只回复一次
+
+    状态保存在有数量上限的 LRU 中，每个键带过期时间，过期的键在访问或淘汰时清理。
+    """
+    def __init__(self, cooldown: float = KEYWORD_COOLDOWN, thread_ttl: float = KEYWORD_THREAD_TTL, max_entries: int = 10000):
+        self.cooldown = cooldown
+        self.thread_ttl = thread_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # 键 -> 过期时间
+
+    def _active(self, key: tuple, now: float) -> bool:
+        expires_at = self.entries.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= now:
+            del self.entries[key]
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def _set(self, key: tuple, ttl: float, now: float) -> None:
+        self.entries[key] = now + ttl
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def allow(self, chat_id: int, keyword: str, thread_id: Optional[int], now: float) -> bool:
+        """检查是否允许回复，允许时同时记录冷却和话题状态"""
+        cooldown_key = ("cooldown", chat_id, keyword)
+        thread_key = ("thread", chat_id, thread_id, keyword)
+        if self._active(cooldown_key, now) or (thread_id is not None and self._active(thread_key, now)):
+            return False
+        self._set(cooldown_key, self.cooldown, now)
+        if thread_id is not None:
+            self._set(thread_key, self.thread_ttl, now)
+        return True
+
+keyword_throttle = KeywordReplyThrottle()
+pending_keyword_replies = {}  # (群组ID, 关键词) -> 等待合并发送期间触发的消息
+
+class FloodDetector:
+    """滑动窗口刷屏检测：每个 (群组, 用户) 保存最近 max_messages 条消息时间戳的环形缓冲区
+
+    每条消息 O(1)；最久未发言的条目在 OrderedDict 头部，空闲超过 idle_ttl 或总数超过 max_tracked 时淘汰。
+    """
+    def __init__(self, max_messages: int, window: float, idle_ttl: float = 300, max_tracked: int = 100000):
+        self.max_messages = max_messages
+        self.window = window
+        self.idle_ttl = idle_ttl
+        self.max_tracked = max_tracked
+        self.counters = collections.OrderedDict()  # (群组ID, 用户ID) -> [时间戳环形缓冲区, 写入位置, 最后发言时间]
+
+    def hit(self, chat_id: int, user_id: int, now: float) -> bool:
+        """记录一条消息，返回是否触发刷屏"""
+        key = (chat_id, user_id)
+        entry = self.counters.get(key)
+        if entry is None:
+            entry = self.counters[key] = [array("d", bytes(8 * self.max_messages)), 0, now]
+        else:
+            self.counters.move_to_end(key)
+        ring, pos, _ = entry
+        oldest = ring[pos]  # 将被覆盖的位置保存的是第 N 条之前的时间戳
+        ring[pos] = now
+        entry[1] = (pos + 1) % self.max_messages
+        entry[2] = now
+        self._evict(now)
+        
+        if oldest and now - oldest <= self.window:
+            for i in range(self.max_messages):
+                ring[i] = 0  # 清空，避免同一次刷屏重复触发
+            return True
+        return False
+
+    def _evict(self, now: float) -> None:
+        counters = self.counters
+        while counters:
+            key, entry = next(iter(counters.items()))
+            if now - entry[2] <= self.idle_ttl and len(counters) <= self.max_tracked:
+                break
+            counters.popitem(last=False)
+        FLOOD_TRACKED_USERS.set(len(counters))
+
+flood_detector = FloodDetector(FLOOD_MAX_MESSAGES, FLOOD_WINDOW)
+
+MINHASH_PERMUTATIONS = 64
+_minhash_rng = np.random.default_rng(20240601)
+MINHASH_A = _minhash_rng.integers(1, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+MINHASH_B = _minhash_rng.integers(0, 2 ** 63, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def minhash(text: str, ngram: int = 3) -> np.ndarray:
+    """字符 n-gram 集合的 MinHash 签名，相同位置取值相等的比例近似 Jaccard 相似度"""
+    grams = {text[i:i + ngram] for i in range(max(len(text) - ngram + 1, 1))}
+    hashes = np.fromiter((hash(gram) & 0xFFFFFFFFFFFFFFFF for gram in grams), dtype=np.uint64, count=len(grams))
+    # multiply-shift 哈希族，uint64 乘法溢出即取模 2^64
+    mixed = hashes[:, None] * MINHASH_A + MINHASH_B
+    return (mixed >> np.uint64(32)).astype(np.uint32).min(axis=0)
+
+class DuplicateDetector:
+    """跨用户的近似重复消息检测
+
+    MinHash 签名分为 16 段、每段 4 个值作为 LSH 桶键，只与同桶的消息比较；
+    每个群组只保留时间窗口内、最多 max_entries 条消息。
+    """
+    BANDS = 16
+    ROWS = MINHASH_PERMUTATIONS // BANDS
+    
+    def __init__(self, window: float, min_users: int, threshold: float = 0.6,
+                 min_length: int = 10, max_entries: int = 2000, max_clusters: int = 200,
+                 max_candidates: int = 50):
+        self.window = window
+        self.min_users = min_users
+        self.threshold = threshold
+        self.min_length = min_length
+        self.max_entries = max_entries
+        self.max_clusters = max_clusters
+        self.max_candidates = max_candidates
+        self.chats = {}  # 群组ID -> (条目 deque, {桶键: 条目 deque})
+        self.clusters = collections.OrderedDict()  # 相似消息群ID -> 信息
+        self._next_cluster = 0
+
+    def _band_keys(self, signature: np.ndarray) -> List[tuple]:
+        return [
+            (band, signature[band * self.ROWS:(band + 1) * self.ROWS].tobytes())
+            for band in range(self.BANDS)
+        ]
+
+    def _evict(self, entries, buckets, now: float) -> None:
+        # 条目按时间顺序进入每个桶，因此过期条目总在桶的头部
+        while entries and (now - entries[0][0] > self.window or len(entries) > self.max_entries):
+            entry = entries.popleft()
+            for key in entry[6]:
+                bucket = buckets[key]
+                bucket.popleft()
+                if not bucket:
+                    del buckets[key]
+
+    def add(self, chat_id: int, user, text: str, now: float) -> Optional[Dict[str, Any]]:
+        """加入一条消息；形成新的相似消息群时返回该群"""
+        normalized = normalize_text(text)
+        if len(normalized) < self.min_length:
+            return None
+        signature = minhash(normalized)
+        keys = self._band_keys(signature)
+        
+        if chat_id not in self.chats:
+            self.chats[chat_id] = (collections.deque(), {})
+        entries, buckets = self.chats[chat_id]
+        self._evict(entries, buckets, now)
+        
+        # 与同桶的消息比较；命中已有的相似消息群时直接加入，不重复提醒
+        entry = [now, signature, user.id, user.first_name, user.username, None, keys]
+        candidates = []
+        seen = set()
+        min_equal = self.threshold * MINHASH_PERMUTATIONS
+        for key in keys:
+            for other in buckets.get(key, ()):
+                if id(other) in seen or np.count_nonzero(other[1] == signature) < min_equal:
+                    seen.add(id(other))
+                    continue
+                seen.add(id(other))
+                if other[5] in self.clusters:
+                    entry[5] = other[5]
+                    break
+                candidates.append(other)
+                if len(candidates) >= self.max_candidates:
+                    break
+            if entry[5] or len(candidates) >= self.max_candidates:
+                break
+        
+        # [时间, 签名, 用户ID, 名称, 用户名, 相似消息群ID, 桶键]
+        entries.append(entry)
+        for key in keys:
+            buckets.setdefault(key, collections.deque()).append(entry)
+        
+        if entry[5]:
+            cluster = self.clusters[entry[5]]
+            cluster["users"][user.id] = {"name": user.first_name, "username": user.username}
+            return None
+        
+        members = candidates + [entry]
+        if len({member[2] for member in members}) < self.min_users:
+            return None
+        
+        self._next_cluster += 1
+        cluster_id = str(self._next_cluster)
+        for member in members:
+            member[5] = cluster_id
+        cluster = {
+            "id": cluster_id,
+            "chat_id": chat_id,
+            "text": text[:100],
+            "users": {member[2]: {"name": member[3], "username": member[4]} for member in members},
+        }
+        self.clusters[cluster_id] = cluster
+        while len(self.clusters) > self.max_clusters:
+            self.clusters.popitem(last=False)
+        return cluster
+
+duplicate_detector = DuplicateDetector(DUP_WINDOW, DUP_MIN_USERS, DUP_SIMILARITY)
+
+SUSPICIOUS_LINK = re.compile(r"(https?://|t\.me/|www\.)", re.IGNORECASE)
+SUSPICIOUS_NAME = re.compile(r"(\d{5,}|airdrop|usdt|support|客服|空投|免费|福利|代理|招聘|私聊)")
+
+class JoinGuard:
+    """按群组统计滑动窗口内的加入人数，出现突增时开启防护模式，最后一次加入 lockdown 秒后自动解除"""
+    def __init__(self, burst: int, window: float, lockdown: float):
+        self.burst = burst
+        self.window = window
+        self.lockdown = lockdown
+        self.joins = {}  # 群组ID -> deque[(时间, 用户ID)]
+        self.lockdowns = {}  # 群组ID -> 防护模式结束时间
+
+    def record(self, chat_id: int, user_id: int, now: float) -> bool:
+        """记录一次加入，返回本次是否新开启了防护模式"""
+        joins = self.joins.get(chat_id)
+        if joins is None:
+            joins = self.joins[chat_id] = collections.deque()
+        joins.append((now, user_id))
+        while joins and now - joins[0][0] > self.window:
+            joins.popleft()
+        
+        if self.is_locked(chat_id, now):
+            self.lockdowns[chat_id] = now + self.lockdown  # 仍有人加入，延长防护
+            return False
+        if len(joins) >= self.burst:
+            self.lockdowns[chat_id] = now + self.lockdown
+            return True
+        return False
+
+    def is_locked(self, chat_id: int, now: float) -> bool:
+        return self.lockdowns.get(chat_id, 0) > now
+
+    def recent_joiners(self, chat_id: int) -> List[int]:
+        return [user_id for _, user_id in self.joins.get(chat_id, ())]
+
+    @staticmethod
+    def is_suspicious(user) -> bool:
+        """名称含链接、长数字串、推广词或命中垃圾消息规则"""
+        name = f"{user.full_name} {user.username or ''}"
+        return bool(
+            SUSPICIOUS_LINK.search(name)
+            or SUSPICIOUS_NAME.search(normalize_text(name))
+            or spam_filter.match(user.full_name)
+        )
+
+join_guard = JoinGuard(JOIN_BURST, JOIN_WINDOW, LOCKDOWN_DURATION)
+
+async def restrict_member(bot, chat_id: int, user_id: int, until_date: datetime) -> None:
+    """禁言群组成员直到 until_date"""
+    await bot.restrict_chat_member(
+        chat_id=chat_id,
+        user_id=user_id,
+        permissions=ChatPermissions(
+            can_send_messages=False,
+            can_send_audios=False,
+            can_send_documents=False,
+            can_send_photos=False,
+            can_send_videos=False,
+            can_send_video_notes=False,
+            can_send_voice_notes=False,
+            can_send_other_messages=False,
+            can_add_web_page_previews=False,
+            can_invite_users=False,
+            can_pin_messages=False,
+            can_change_info=False,
+        ),
+        until_date=until_date
+    )
+
 async def delete_message_later(message, delay: int = 120):  # Set delay to 2 minutes
     """在指定时间后删除消息"""
     await asyncio.sleep(delay)
@@ -583,6 +2325,421 @@ async def delete_message_later(message, delay: int = 120):  # Set delay to 2 min
     except Exception as e:
         logger.error(f"删除消息失败: {e}")
 
+async def run_rate_limited(calls, limit: int = BAN_CONCURRENCY, retries: int = 3) -> List[Any]:
+    """并发执行 Bot API 调用，遇到 429 时按 retry_after 等待后重试
+
+    calls 为无参数的协程函数列表，返回值与 asyncio.gather(return_exceptions=True) 相同
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(call):
+        async with semaphore:
+            for attempt in range(retries):
+                try:
+                    return await call()
+                except RetryAfter as e:
+                    if attempt == retries - 1:
+                        raise
+                    await asyncio.sleep(float(e.retry_after))
+
+    return await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
+
+chat_admins_cache = {}  # 群组ID -> (缓存时间, 管理员ID集合)
+
+async def get_chat_admin_ids(bot, chat_id: int, ttl: float = 600) -> set:
+    """获取群组管理员ID，缓存 ttl 秒"""
+    cached = chat_admins_cache.get(chat_id)
+    if cached and time_module.monotonic() - cached[0] < ttl:
+        return cached[1]
+    try:
+        admins = await bot.get_chat_administrators(chat_id)
+        admin_ids = {admin.user.id for admin in admins}
+    except Exception as e:
+        logger.error(f"获取群组管理员失败: {e}")
+        admin_ids = cached[1] if cached else set()
+    chat_admins_cache[chat_id] = (time_module.monotonic(), admin_ids)
+    return admin_ids
+
+async def is_exempt_sender(bot, message, user) -> bool:
+    """匿名管理员、关联频道自动转发的消息和管理员发送的消息不做自动处理"""
+    sender_chat = message.sender_chat
+    if sender_chat and (sender_chat.id == message.chat_id or message.is_automatic_forward):
+        return True
+    return user.id in ADMIN_USER_IDS or user.id in await get_chat_admin_ids(bot, message.chat_id)
+
+async def notify_admins(bot, text: str) -> None:
+    """私信通知所有配置的管理员"""
+    await run_rate_limited([
+        (lambda admin_id=admin_id: bot.send_message(chat_id=admin_id, text=text))
+        for admin_id in ADMIN_USER_IDS
+    ])
+
+async def auto_moderate(bot, message, user, action: str, reason: str, detail: str, duration: Optional[timedelta] = None) -> None:
+    """对自动检测到的违规消息执行动作：flag 通知管理员，delete 删除，mute 删除并禁言，ban 删除并封禁"""
+    chat = message.chat
+    name = user.full_name
+    if action == "flag":
+        link = f"https://t.me/c/{str(chat.id).removeprefix('-100')}/{message.message_id}"
+        await notify_admins(bot, f"🚩 {chat.title} 中 {name} (ID: {user.id}) 的消息疑似{reason}\n{detail}\n{link}")
+        return
+        
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning(f"删除违规消息失败: {e}")
+    if action == "delete":
+        return
+        
+    record = {
+        "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
+        "电报群组名称": chat.title,
+        "用户ID": user.id,
+        "用户名": f"@{user.username}" if user.username else "无",
+        "名称": user.first_name,
+        "操作管理": "自动检测",
+        "理由": reason,
+    }
+    if action == "mute":
+        duration = clamp_mute_duration(duration or parse_duration(SPAM_MUTE_DURATION) or timedelta(days=1))
+        until_date = datetime.now(TIMEZONE) + duration
+        await restrict_member(bot, chat.id, user.id, until_date)
+        mute_index.add(chat.title, user.id, until_date.timestamp(), chat_id=chat.id, name=user.first_name, reason=reason, operator="自动检测")
+        record["操作"] = f"禁言 {format_duration(duration)}"
+    else:
+        await bot.ban_chat_member(chat_id=chat.id, user_id=user.id, revoke_messages=True)
+        record["操作"] = "封禁"
+        spawn_background(federate_and_report(
+            bot, chat.id, {user.id: {"name": user.first_name, "username": user.username}}, reason, "自动检测"
+        ), "federation")
+    moderation_events.publish(record)
+    logger.info(f"自动{action}: {name} ({user.id}) 于 {chat.title} - {reason}: {detail}")
+
+def publish_federated_ban(chat, user) -> None:
+    """记录联邦封禁名单中的用户在受管群组被自动封禁"""
+    moderation_events.publish({
+        "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
+        "电报群组名称": chat.title,
+        "用户ID": user.id,
+        "用户名": f"@{user.username}" if user.username else "无",
+        "名称": user.first_name,
+        "操作管理": "自动检测",
+        "理由": "联邦封禁名单",
+        "操作": "联邦封禁"
+    })
+
+async def spam_filter_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """用垃圾消息规则扫描每条群组消息"""
+    message = update.effective_message
+    user = update.effective_user
+    if not message or not user:
+        return
+    spam_filter.maybe_reload()
+    rule = spam_filter.match(message.text or message.caption or "")
+    if not rule or await is_exempt_sender(context.bot, message, user):
+        return
+        
+    action, reason, pattern = rule
+    SPAM_MATCHES.labels(action=action).inc()
+    try:
+        await auto_moderate(context.bot, message, user, action, reason, f"命中规则: {pattern}")
+    except Exception as e:
+        logger.error(f"处理垃圾消息失败: {e}")
+    if action != "flag":
+        raise ApplicationHandlerStop  # 消息已处理，不再交给后续处理器（记录、自动回复等）
+
+async def flood_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """检测刷屏，超过阈值时自动禁言"""
+    message = update.effective_message
+    user = update.effective_user
+    if not message or not user:
+        return
+    if message.sender_chat:
+        return  # 匿名管理员和以频道身份发言时 from_user 是共用的占位账号，无法按用户计数和禁言
+    if not flood_detector.hit(message.chat_id, user.id, time_module.monotonic()):
+        return
+    if await is_exempt_sender(context.bot, message, user):
+        return
+        
+    FLOOD_DETECTIONS.inc()
+    duration = parse_duration(FLOOD_MUTE_DURATION) or timedelta(minutes=10)
+    try:
+        await auto_moderate(
+            context.bot, message, user, "mute", "刷屏",
+            f"{FLOOD_WINDOW:g} 秒内发送超过 {FLOOD_MAX_MESSAGES} 条消息", duration
+        )
+    except Exception as e:
+        logger.error(f"处理刷屏失败: {e}")
+    raise ApplicationHandlerStop  # 消息已删除，不再交给后续处理器
+
+async def duplicate_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """检测多个用户发送的相似消息，提醒管理员批量处理"""
+    message = update.effective_message
+    user = update.effective_user
+    text = message.text or message.caption if message else None
+    if not text or not user:
+        return
+    # 匿名管理员、频道身份发言和管理员的消息不参与检测
+    if message.sender_chat or await is_exempt_sender(context.bot, message, user):
+        return
+    cluster = duplicate_detector.add(message.chat_id, user, text, time_module.monotonic())
+    if not cluster:
+        return
+        
+    DUPLICATE_CLUSTERS.inc()
+    keyboard = [[
+        InlineKeyboardButton("🚫 全部封禁", callback_data=f"dup:ban:{cluster['id']}"),
+        InlineKeyboardButton("忽略", callback_data=f"dup:ignore:{cluster['id']}")
+    ]]
+    alert = await context.bot.send_message(
+        chat_id=message.chat_id,
+        text=f"⚠️ 检测到 {len(cluster['users'])} 个用户发送相似消息:\n{cluster['text']}",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    spawn_background(delete_message_later(alert, delay=DUP_WINDOW), "delete_message")
+
+async def duplicate_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理相似消息群的批量封禁/忽略按钮"""
+    query = update.callback_query
+    await query.answer()
+    if not await check_admin(update, context):
+        return
+        
+    _, action, cluster_id = query.data.split(":", 2)
+    cluster = duplicate_detector.clusters.pop(cluster_id, None)
+    if not cluster:
+        await query.message.edit_text("该提醒已过期")
+        return
+    if action != "ban":
+        await query.message.edit_text("已忽略")
+        spawn_background(delete_message_later(query.message, delay=10), "delete_message")
+        return
+        
+    chat = query.message.chat
+    admin_ids = await get_chat_admin_ids(context.bot, chat.id)
+    targets = {uid: info for uid, info in cluster["users"].items() if uid not in admin_ids and uid != context.bot.id}
+    banned, failed = await ban_users(context.bot, chat, targets, "广告", query.from_user.full_name)
+    
+    managed_chats[chat.id] = chat.title
+    spawn_background(federate_and_report(
+        context.bot, chat.id, {uid: targets[uid] for uid in banned}, "广告", query.from_user.full_name, query.from_user.id
+    ), "federation")
+    
+    summary = f"✅ 已封禁 {len(banned)} 个发送相似消息的用户"
+    if failed:
+        summary += f"\n❌ 失败 {len(failed)} 个"
+    await query.message.edit_text(summary)
+    spawn_background(delete_message_later(query.message, delay=30), "delete_message")
+
+async def lift_lockdown_later(bot, chat_id: int) -> None:
+    """等待防护模式结束（期间可能被延长）后通知群组"""
+    while True:
+        remaining = join_guard.lockdowns.get(chat_id, 0) - time_module.monotonic()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(remaining)
+    join_guard.lockdowns.pop(chat_id, None)
+    logger.info(f"群组 {chat_id} 已解除防护模式")
+    try:
+        msg = await bot.send_message(chat_id=chat_id, text="🔓 加群高峰已过去，防护模式已解除")
+        spawn_background(delete_message_later(msg, delay=60), "delete_message")
+    except Exception as e:
+        logger.error(f"发送解除防护通知失败: {e}")
+
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """跟踪新成员加入，检测加群突增和可疑名称"""
+    change = update.chat_member
+    if not change:
+        return
+    old, new = change.old_chat_member, change.new_chat_member
+    joined = old.status in (ChatMember.LEFT, ChatMember.BANNED) and (
+        new.status == ChatMember.MEMBER or (new.status == ChatMember.RESTRICTED and new.is_member)
+    )
+    if not joined:
+        return
+        
+    chat = change.chat
+    user = new.user
+    bot = context.bot
+    now = time_module.monotonic()
+    
+    # 联邦封禁名单中的用户直接封禁
+    if federation_enabled and user.id in federated_banned_ids and chat.id in managed_chats:
+        try:
+            await bot.ban_chat_member(chat_id=chat.id, user_id=user.id)
+            publish_federated_ban(chat, user)
+            logger.info(f"联邦封禁名单用户 {user.id} 加入群组 {chat.id}，已封禁")
+        except Exception as e:
+            logger.error(f"执行联邦封禁失败: {e}")
+        return
+    
+    started = join_guard.record(chat.id, user.id, now)
+    until_date = datetime.now(TIMEZONE) + clamp_mute_duration(timedelta(seconds=LOCKDOWN_DURATION))
+    if started:
+        JOIN_LOCKDOWNS.inc()
+        logger.warning(f"群组 {chat.title} 在 {JOIN_WINDOW:g} 秒内有 {JOIN_BURST} 人加入，开启防护模式")
+        # 限制本次突增中加入的所有成员
+        await run_rate_limited([
+            (lambda user_id=user_id: restrict_member(bot, chat.id, user_id, until_date))
+            for user_id in join_guard.recent_joiners(chat.id)
+        ])
+        spawn_background(lift_lockdown_later(bot, chat.id), "lockdown")
+        try:
+            msg = await bot.send_message(
+                chat_id=chat.id,
+                text="🔒 检测到大量用户短时间内加入，已开启防护模式，新成员将暂时无法发言"
+            )
+            spawn_background(delete_message_later(msg, delay=120), "delete_message")
+        except Exception as e:
+            logger.error(f"发送防护模式通知失败: {e}")
+        await notify_admins(bot, f"🔒 {chat.title} 检测到加群突增，已开启防护模式")
+        return
+    
+    suspicious = JoinGuard.is_suspicious(user)
+    if join_guard.is_locked(chat.id, now) or suspicious:
+        try:
+            await restrict_member(bot, chat.id, user.id, until_date)
+        except Exception as e:
+            logger.error(f"限制新成员失败: {e}")
+    if suspicious:
+        await notify_admins(bot, f"👀 {chat.title} 有可疑名称的用户加入: {user.full_name} (ID: {user.id})，已暂时限制发言")
+
+async def spam_reload_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理/spamreload命令，重新加载垃圾消息规则"""
+    if not await check_admin(update, context):
+        return
+    count = spam_filter.load()
+    await update.message.reply_text(f"✅ 已加载 {count} 条垃圾消息规则")
+
+async def track_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """记录群组最近的消息"""
+    message = update.effective_message
+    user = update.effective_user
+    if not message or not user:
+        return
+    chat_messages = recent_messages.get(message.chat_id)
+    if chat_messages is None:
+        chat_messages = recent_messages[message.chat_id] = collections.deque(maxlen=RECENT_MESSAGES_PER_CHAT)
+    chat_messages.append({
+        "time": time_module.time(),
+        "user_id": user.id,
+        "name": user.first_name,
+        "username": user.username,
+        "message_id": message.message_id,
+        "text": (message.text or message.caption or "").strip(),
+    })
+    
+    # 联邦封禁名单中的用户在任一受管群组发言时立即封禁
+    if federation_enabled and user.id in federated_banned_ids and message.chat_id in managed_chats:
+        try:
+            await context.bot.ban_chat_member(chat_id=message.chat_id, user_id=user.id, revoke_messages=True)
+            publish_federated_ban(message.chat, user)
+            logger.info(f"联邦封禁名单用户 {user.id} 在群组 {message.chat_id} 发言，已封禁")
+        except Exception as e:
+            logger.error(f"执行联邦封禁失败: {e}")
+
+def can_federate(origin_chat_id: int, operator_id: Optional[int]) -> bool:
+    """联邦封禁需已启用、来源为受信任群组，且由 ADMIN_USER_IDS 中的管理员操作（自动检测时 operator_id 为 None）"""
+    if not federation_enabled or origin_chat_id not in FEDERATED_CHAT_IDS:
+        return False
+    return operator_id is None or operator_id in ADMIN_USER_IDS
+
+async def federate_bans(bot, origin_chat_id: int, users: Dict[int, Dict[str, Any]], reason: str, operator: str, operator_id: Optional[int] = None) -> Dict[int, Dict[str, int]]:
+    """将封禁同步到其他受管群组，返回每个群组的成功/失败数
+
+    users 为 用户ID -> {"name": 名称, "username": 用户名}；不满足 can_federate 时不记录也不同步
+    """
+    if not can_federate(origin_chat_id, operator_id):
+        return {}
+    federated_banned_ids.update(users)
+    chat_ids = [chat_id for chat_id in managed_chats if chat_id != origin_chat_id]
+    if not chat_ids or not users:
+        return {}
+    
+    pairs = [(chat_id, user_id) for chat_id in chat_ids for user_id in users]
+    results = await run_rate_limited([
+        (lambda chat_id=chat_id, user_id=user_id: bot.ban_chat_member(chat_id=chat_id, user_id=user_id, revoke_messages=True))
+        for chat_id, user_id in pairs
+    ])
+    
+    now = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+    per_chat = {chat_id: {"ok": 0, "failed": 0} for chat_id in chat_ids}
+    records = []
+    for (chat_id, user_id), result in zip(pairs, results):
+        if isinstance(result, Exception):
+            logger.error(f"联邦封禁用户 {user_id} 于群组 {chat_id} 失败: {result}")
+            per_chat[chat_id]["failed"] += 1
+            continue
+        per_chat[chat_id]["ok"] += 1
+        info = users[user_id]
+        records.append({
+            "操作时间": now,
+            "电报群组名称": managed_chats.get(chat_id) or str(chat_id),
+            "用户ID": user_id,
+            "用户名": f"@{info['username']}" if info.get("username") else "无",
+            "名称": info.get("name", ""),
+            "操作管理": operator,
+            "理由": reason,
+            "操作": "联邦封禁"
+        })
+    
+    moderation_events.publish(*records)
+    return per_chat
+
+async def federate_and_report(bot, origin_chat_id: int, users: Dict[int, Dict[str, Any]], reason: str, operator: str, operator_id: Optional[int] = None) -> None:
+    """在后台执行联邦封禁，并在原群组发送结果"""
+    try:
+        per_chat = await federate_bans(bot, origin_chat_id, users, reason, operator, operator_id)
+        if per_chat:
+            summary_msg = await bot.send_message(chat_id=origin_chat_id, text=format_federation_summary(per_chat).strip())
+            spawn_background(delete_message_later(summary_msg, delay=30), "delete_message")
+    except Exception as e:
+        logger.error(f"联邦封禁失败: {e}")
+
+def format_federation_summary(per_chat: Dict[int, Dict[str, int]]) -> str:
+    """格式化联邦封禁结果"""
+    if not per_chat:
+        return ""
+    failed = [managed_chats.get(chat_id) or str(chat_id) for chat_id, result in per_chat.items() if result["failed"]]
+    summary = f"\n🌐 联邦封禁: {len(per_chat) - len(failed)}/{len(per_chat)} 个群组成功"
+    if failed:
+        summary += f"（失败: {', '.join(failed[:10])}）"
+    return summary
+
+async def my_chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """跟踪机器人担任管理员的群组"""
+    change = update.my_chat_member
+    chat = change.chat
+    if change.new_chat_member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
+        managed_chats[chat.id] = chat.title
+        logger.info(f"机器人成为群组管理员: {chat.title} ({chat.id})")
+    elif chat.id in managed_chats:
+        del managed_chats[chat.id]
+        logger.info(f"机器人不再管理群组: {chat.title} ({chat.id})")
+
+async def federation_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理/fed命令：/fed on|off 切换联邦封禁，无参数时显示状态"""
+    global federation_enabled
+    
+    # 联邦开关影响所有群组，只允许 ADMIN_USER_IDS 中的管理员使用
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ 只有机器人管理员可以使用此命令")
+        return
+        
+    chat = update.effective_chat
+    managed_chats[chat.id] = chat.title  # 管理员在此使用命令，视为受管群组
+    
+    if context.args and context.args[0].lower() in ("on", "off"):
+        federation_enabled = context.args[0].lower() == "on"
+        
+    status = "已启用" if federation_enabled else "已禁用"
+    chats = "\n".join(f"• {title or chat_id}" for chat_id, title in managed_chats.items())
+    await update.message.reply_text(
+        f"🌐 联邦封禁{status}\n"
+        f"🚫 共享封禁名单: {len(federated_banned_ids)} 个用户\n"
+        f"🔐 当前群组{'已' if chat.id in FEDERATED_CHAT_IDS else '未'}列入受信任群组 (FEDERATED_CHAT_IDS)\n\n"
+        f"受管群组:\n{chats}"
+    )
+
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理/start命令"""
     user = update.effective_user
@@ -607,11 +2764,16 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "📋 主要功能：\n"
         "├─ 👮 封禁管理\n"
         "│  ├─ /b - 封禁用户（回复消息使用）\n"
+        "│  ├─ /kb - 批量封禁（用户ID列表，或回复消息封禁发送相同内容的用户）\n"
         "│  ├─ /m - 禁言用户（回复消息并指定时间）\n"
-        "│  └─ /um - 解除禁言\n\n"
+        "│  ├─ /um - 解除禁言\n"
+        "│  └─ /mutes - 查看生效中的禁言\n\n"
         "├─ 📊 记录管理\n"
-        "│  ├─ /records - 查看封禁记录\n"
+        "│  ├─ /records [时长] - 查看封禁记录\n"
         "│  ├─ /search <关键词> - 搜索封禁记录\n"
+        "│  ├─ /history <用户> - 查看用户历史记录\n"
+        "│  ├─ /byadmin <名称> - 查看管理员操作记录\n"
+        "│  ├─ /stats [时长] - 查看处理统计\n"
         "│  └─ /export - 导出封禁记录\n\n"
         "├─ 📝 关键词回复\n"
         "│  └─ /reply - 管理关键词自动回复\n\n"
@@ -680,7 +2842,8 @@ async def ban_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             "user_id": user.id,
             "banned_user_name": banned_user_name,
             "banned_username": banned_username,
-            "message_id": message.message_id  # 添加消息ID
+            "message_id": message.message_id,  # 添加消息ID
+            "replied_message_id": reply_to_message.message_id  # 被回复的消息，封禁时一并删除
         }
         
         # 创建理由选择按钮
@@ -699,107 +2862,210 @@ async def ban_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
+        # 附带该用户的历史记录，方便管理员判断
+        prompt = f"请选择封禁用户 {user.first_name} 的理由："
+        history = record_lookup.get("user", user.id)
+        if history:
+            last = ban_records[newest_first(history)[0]]
+            prompt += (
+                f"\n⚠️ 历史记录: {summarize_actions(history)}"
+                f"\n最近一次: {last.get('操作时间', '')} {last.get('操作', '')} - {last.get('理由', '')}"
+            )
+        
         # 发送选择理由的消息
-        sent_message = await message.reply_text(
-            f"请选择封禁用户 {user.first_name} 的理由：",
-            reply_markup=reply_markup
-        )
+        sent_message = await message.reply_text(prompt, reply_markup=reply_markup)
         
         # 30秒后删除消息
-        asyncio.create_task(delete_message_later(sent_message, delay=30))
+        spawn_background(delete_message_later(sent_message, delay=30), "delete_message")
         
     except Exception as e:
         logger.error(f"处理封禁命令时出错: {e}")
         await message.reply_text("处理封禁命令时出错")
 
 async def ban_reason_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理封禁原因选择"""
+    """处理封禁原因选择：先执行封禁，记录交给后台写入"""
     query = update.callback_query
-    await query.answer()
     
     try:
-        action, user_id_str, username, reason = query.data.split("|")
-        banned_user_id = int(user_id_str)
-        last_ban = context.chat_data.get("last_ban", {})
+        action, user_id_str, username, reason = query.data.split("|")
+        banned_user_id = int(user_id_str)
+    except ValueError:
+        await query.answer()
+        return  # 无效的回调数据，直接返回
+        
+    last_ban = context.chat_data.get("last_ban", {})
+    
+    # 检查是否是同一个操作，并验证操作权限
+    if not last_ban or last_ban.get("user_id") != banned_user_id or query.from_user.id != last_ban.get("operator_id"):
+        await query.answer()
+        return  # 如果不是执行操作的管理员，直接返回，不显示任何消息
+        
+    del context.chat_data["last_ban"]
+    chat = query.message.chat
+    username = username if username and username != "None" else None
+    banned_user_name = last_ban.get("banned_user_name", "")
+    
+    # 同时应答回调、封禁用户（并撤回其消息）、删除被回复的消息和理由选择消息
+    steps = [
+        query.answer(),
+        context.bot.ban_chat_member(chat_id=chat.id, user_id=banned_user_id, revoke_messages=True),
+        query.message.delete(),
+    ]
+    if last_ban.get("replied_message_id"):
+        steps.append(context.bot.delete_message(chat_id=chat.id, message_id=last_ban["replied_message_id"]))
+    _, ban_result, *cleanup_results = await asyncio.gather(*steps, return_exceptions=True)
+    
+    for result in cleanup_results:
+        if isinstance(result, Exception):
+            logger.warning(f"清理封禁相关消息失败: {result}")
+    
+    if isinstance(ban_result, Exception):
+        logger.error(f"封禁用户失败: {ban_result}")
+        error_msg = await context.bot.send_message(chat_id=chat.id, text=f"❌ 封禁失败: {ban_result}")
+        spawn_background(delete_message_later(error_msg, delay=10), "delete_message")  # 错误消息10秒后删除
+        return
+    
+    # 记录交给后台写入，不阻塞处理器
+    record = {
+        "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
+        "电报群组名称": chat.title,
+        "用户ID": banned_user_id,
+        "用户名": f"@{username}" if username else "无",
+        "名称": banned_user_name,
+        "操作管理": query.from_user.full_name,
+        "理由": reason,
+        "操作": "封禁"
+    }
+    moderation_events.publish(record)
+    
+    # 同步封禁到其他受管群组
+    managed_chats[chat.id] = chat.title
+    spawn_background(federate_and_report(
+        context.bot,
+        chat.id,
+        {banned_user_id: {"name": banned_user_name, "username": username}},
+        reason,
+        query.from_user.full_name,
+        query.from_user.id
+    ), "federation")
+    
+    # 发送确认消息，2秒后删除
+    try:
+        confirm_msg = await context.bot.send_message(
+            chat_id=chat.id,
+            text=f"✅ 已封禁用户 {banned_user_name} 并删除其消息 - 理由: {reason}"
+        )
+        spawn_background(delete_message_later(confirm_msg, delay=2), "delete_message")
+    except Exception as e:
+        logger.error(f"发送封禁确认消息失败: {e}")
+
+async def ban_users(bot, chat, targets: Dict[int, Dict[str, Any]], reason: str, operator: str) -> tuple:
+    """并发封禁多个用户，并一次性提交所有成功的记录，返回 (成功的用户ID列表, 失败的用户ID列表)
+
+    targets 为 用户ID -> {"name": 名称, "username": 用户名}
+    """
+    user_ids = list(targets)
+    results = await run_rate_limited([
+        (lambda uid=uid: bot.ban_chat_member(chat_id=chat.id, user_id=uid, revoke_messages=True))
+        for uid in user_ids
+    ])
+    
+    now = datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+    records = []
+    banned = []
+    failed = []
+    for uid, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"批量封禁用户 {uid} 失败: {result}")
+            failed.append(uid)
+            continue
+        banned.append(uid)
+        info = targets[uid]
+        records.append({
+            "操作时间": now,
+            "电报群组名称": chat.title,
+            "用户ID": uid,
+            "用户名": f"@{info['username']}" if info.get("username") else "无",
+            "名称": info.get("name", ""),
+            "操作管理": operator,
+            "理由": reason,
+            "操作": "封禁"
+        })
+    
+    moderation_events.publish(*records)
+    return banned, failed
+
+async def batch_ban_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """批量封禁：/kb [理由] <用户ID>...，或回复一条消息封禁最近发送相同内容的所有用户"""
+    if not await check_admin(update, context):
+        return
+        
+    message = update.message
+    chat = message.chat
+    try:
+        # 解析参数：数字为用户ID，其余作为理由
+        targets = {}
+        reason_parts = []
+        for arg in context.args:
+            if arg.lstrip("-").isdigit():
+                targets[int(arg)] = {"name": "", "username": None}
+            else:
+                reason_parts.append(arg)
+        reason = " ".join(reason_parts) or "广告"
         
-        # 检查是否是同一个操作
-        if not last_ban or last_ban.get("user_id") != banned_user_id:
-            return  # 如果不是同一个操作，直接返回
-            
-        # 验证操作权限
-        if query.from_user.id != last_ban.get("operator_id"):
-            return  # 如果不是执行操作的管理员，直接返回，不显示任何消息
-            
-        banned_user_name = last_ban.get("banned_user_name", "")
-        banned_username = f"@{username}" if username else "无"
+        # 回复消息时，收集窗口内发送相同内容的用户
+        replied = message.reply_to_message
+        if replied and replied.from_user and not replied.sender_chat:
+            targets[replied.from_user.id] = {
+                "name": replied.from_user.first_name,
+                "username": replied.from_user.username,
+            }
+            text = (replied.text or replied.caption or "").strip()
+            since = time_module.time() - RAID_WINDOW
+            if text:
+                for item in recent_messages.get(chat.id, ()):
+                    if item["time"] >= since and item["text"] == text:
+                        targets[item["user_id"]] = {"name": item["name"], "username": item["username"]}
         
-        # 保存封禁记录
-        try:
-            success = await sheets_storage.save_to_sheet(
-                {
-                    "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
-                    "电报群组名称": query.message.chat.title,
-                    "用户ID": banned_user_id,
-                    "用户名": banned_username,
-                    "名称": banned_user_name,
-                    "操作管理": query.from_user.full_name,
-                    "理由": reason,
-                    "操作": "封禁"
-                }
+        # 跳过群组管理员、机器人管理员和机器人自己
+        protected = await get_chat_admin_ids(context.bot, chat.id) | set(ADMIN_USER_IDS) | {message.from_user.id, context.bot.id}
+        skipped = [uid for uid in targets if uid in protected]
+        for uid in skipped:
+            del targets[uid]
+        if not targets:
+            await message.reply_text(
+                (f"已跳过 {len(skipped)} 个管理员\n" if skipped else "") +
+                "请提供要封禁的用户ID，例如: /kb 广告 123456 789012\n"
+                "或回复一条消息，封禁最近发送相同内容的所有用户"
             )
-            
-            if success:
-                # 获取被回复的消息
-                replied_message = None
-                try:
-                    # 获取原始命令消息
-                    command_message = await context.bot.get_message(
-                        chat_id=query.message.chat.id,
-                        message_id=last_ban.get("message_id")
-                    )
-                    if command_message and command_message.reply_to_message:
-                        replied_message = command_message.reply_to_message
-                except Exception as e:
-                    logger.error(f"获取被回复消息失败: {e}")
-                
-                # 封禁用户并删除消息
-                await context.bot.ban_chat_member(
-                    chat_id=query.message.chat.id,
-                    user_id=banned_user_id,
-                    revoke_messages=True  # 删除用户的所有消息
-                )
-                
-                # 如果找到了被回复的消息，尝试删除它
-                if replied_message:
-                    try:
-                        await replied_message.delete()
-                    except Exception as e:
-                        logger.error(f"删除被回复消息失败: {e}")
-            
-                # 立即删除选择理由的消息
-                await query.message.delete()
-                
-                # 发送确认消息并立即删除
-                confirm_msg = await query.message.reply_text(f"✅ 已封禁用户 {banned_user_name} 并删除其消息 - 理由: {reason}")
-                await asyncio.sleep(2)  # 等待2秒让用户看到确认消息
-                await confirm_msg.delete()
-                
-                # 清理操作数据
-                if "last_ban" in context.chat_data:
-                    del context.chat_data["last_ban"]
-            else:
-                error_msg = await query.message.reply_text("❌ 保存记录失败")
-                asyncio.create_task(delete_message_later(error_msg, delay=10))  # 错误消息10秒后删除
-                asyncio.create_task(delete_message_later(query.message, delay=10))
-            
-        except Exception as e:
-            error_msg = await query.message.reply_text(f"❌ 保存失败: {str(e)}")
-            asyncio.create_task(delete_message_later(error_msg, delay=10))  # 错误消息10秒后删除
-            asyncio.create_task(delete_message_later(query.message, delay=10))
-            logger.error(f"保存封禁原因失败: {e}")
-            
-    except ValueError:
-        return  # 无效的回调数据，直接返回
+            return
+        
+        # 并发封禁，记录一次性写入
+        banned, failed = await ban_users(context.bot, chat, targets, reason, message.from_user.full_name)
+        
+        # 同步封禁到其他受管群组
+        managed_chats[chat.id] = chat.title
+        per_chat = await federate_bans(
+            context.bot,
+            chat.id,
+            {uid: targets[uid] for uid in banned},
+            reason,
+            message.from_user.full_name,
+            message.from_user.id
+        )
+        
+        summary = f"✅ 已批量封禁 {len(banned)} 个用户 - 理由: {reason}"
+        if skipped:
+            summary += f"\n⏭️ 已跳过 {len(skipped)} 个管理员"
+        if failed:
+            summary += f"\n❌ 失败 {len(failed)} 个: {', '.join(map(str, failed[:20]))}"
+        summary += format_federation_summary(per_chat)
+        sent_message = await message.reply_text(summary)
+        spawn_background(delete_message_later(sent_message, delay=60), "delete_message")
+        
+    except Exception as e:
+        logger.error(f"处理批量封禁命令时出错: {e}")
+        await message.reply_text("处理批量封禁命令时出错")
 
 async def mute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理禁言命令"""
@@ -836,27 +3102,9 @@ async def mute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             return
         
         # 解析禁言时间
-        duration_str = " ".join(context.args)
-        try:
-            # 解析时间格式
-            days = 0
-            hours = 0
-            minutes = 0
-            
-            if "d" in duration_str:
-                days = int(duration_str.split("d")[0])
-                duration_str = duration_str.split("d")[1]
-            if "h" in duration_str:
-                hours = int(duration_str.split("h")[0])
-                duration_str = duration_str.split("h")[1]
-            if "m" in duration_str:
-                minutes = int(duration_str.split("m")[0])
-                
-            duration = timedelta(days=days, hours=hours, minutes=minutes)
-            until_date = datetime.now(TIMEZONE) + duration
-            
-        except ValueError:
-            await message.reply_text("时间格式错误，请使用例如: 1d2h30m 的格式")
+        duration = parse_duration("".join(context.args))
+        if not duration or not MIN_MUTE_DURATION <= duration <= MAX_MUTE_DURATION:
+            await message.reply_text("时间格式错误，请使用例如: 1d2h30m、90m、2小时 的格式（最短30秒，最长366天）")
             return
             
         # 保存操作上下文
@@ -868,7 +3116,8 @@ async def mute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "user_id": user.id,
             "banned_user_name": banned_user_name,
             "banned_username": banned_username,
-            "duration": duration_str
+            "duration": format_duration(duration),
+            "seconds": duration.total_seconds()
         }
         
         # 创建理由选择按钮
@@ -914,60 +3163,71 @@ async def mute_reason_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     # 验证操作权限
     if query.from_user.id != last_mute.get("operator_id"):
         error_msg = await query.message.reply_text("⚠️ 只有执行禁言的管理员能选择原因")
-        asyncio.create_task(delete_message_later(error_msg))
+        spawn_background(delete_message_later(error_msg), "delete_message")
         return  # 只有执行操作的管理员能选择原因，其他人点击不做任何处理
     
-    # 保存记录
     try:
-        success = await sheets_storage.save_to_sheet(
-            {
-                "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
-                "电报群组名称": last_mute.get("chat_title", query.message.chat.title),
-                "用户ID": muted_user_id,
-                "用户名": banned_username,
-                "名称": banned_user_name,
-                "操作管理": query.from_user.full_name,
-                "理由": reason,
-                "操作": f"禁言 {last_mute.get('duration', '')}"  # Move duration to operation field
-            }
+        # 先禁言用户，记录交给后台写入
+        chat_title = last_mute.get("chat_title", query.message.chat.title)
+        until_date = datetime.now(TIMEZONE) + timedelta(seconds=last_mute.get("seconds", 60))
+        await restrict_member(context.bot, query.message.chat.id, muted_user_id, until_date)
+        mute_index.add(
+            chat_title, muted_user_id, until_date.timestamp(),
+            chat_id=query.message.chat.id,
+            name=banned_user_name,
+            reason=reason,
+            operator=query.from_user.full_name,
         )
         
-        if success:
-            # 禁言用户
-            await context.bot.restrict_chat_member(
-                chat_id=query.message.chat.id,
-                user_id=muted_user_id,
-                permissions=ChatPermissions(
-                    can_send_messages=False,
-                    can_send_audios=False,
-                    can_send_documents=False,
-                    can_send_photos=False,
-                    can_send_videos=False,
-                    can_send_video_notes=False,
-                    can_send_voice_notes=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False,
-                    can_invite_users=False,
-                    can_pin_messages=False,
-                    can_change_info=False,
-                ),
-                until_date=datetime.now(TIMEZONE) + timedelta(minutes=1)  # Example duration
-            )
-            
-            confirm_msg = await query.message.reply_text(f"✅ 已禁言用户 {banned_user_name} - 理由: {reason}")
-            asyncio.create_task(delete_message_later(confirm_msg))
-            asyncio.create_task(delete_message_later(query.message))
-        else:
-            error_msg = await query.message.reply_text("❌ 保存记录失败")
-            asyncio.create_task(delete_message_later(error_msg))
-            asyncio.create_task(delete_message_later(query.message))
+        record = {
+            "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
+            "电报群组名称": chat_title,
+            "用户ID": muted_user_id,
+            "用户名": banned_username,
+            "名称": banned_user_name,
+            "操作管理": query.from_user.full_name,
+            "理由": reason,
+            "操作": f"禁言 {last_mute.get('duration', '')}"  # Move duration to operation field
+        }
+        moderation_events.publish(record)
+        
+        confirm_msg = await query.message.reply_text(
+            f"✅ 已禁言用户 {banned_user_name} {last_mute.get('duration', '')} - 理由: {reason}"
+        )
+        spawn_background(delete_message_later(confirm_msg), "delete_message")
+        spawn_background(delete_message_later(query.message), "delete_message")
         
     except Exception as e:
         error_msg = await query.message.reply_text(f"❌ 操作失败: {str(e)}")
-        asyncio.create_task(delete_message_later(error_msg))
-        asyncio.create_task(delete_message_later(query.message))
+        spawn_background(delete_message_later(error_msg), "delete_message")
+        spawn_background(delete_message_later(query.message), "delete_message")
         logger.error(f"禁言用户失败: {e}")
 
+async def mutes_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理/mutes命令，列出本群当前生效的禁言"""
+    if not await check_admin(update, context):
+        return
+        
+    entries = mute_index.list(update.effective_chat.title)
+    if not entries:
+        msg = await update.message.reply_text("当前没有生效中的禁言")
+        spawn_background(delete_message_later(msg, delay=10), "delete_message")
+        return
+        
+    now = time_module.time()
+    message = f"🔇 生效中的禁言 ({len(entries)}):\n\n"
+    for entry in entries[:50]:
+        expires = datetime.fromtimestamp(entry["expires_at"], TIMEZONE).strftime("%m-%d %H:%M")
+        remaining = format_duration(timedelta(seconds=max(entry["expires_at"] - now, 0)))
+        message += (
+            f"👤 {entry.get('name') or '未知'} (ID: {entry['user_id']})\n"
+            f"⏳ 剩余 {remaining}，{expires} 到期\n"
+            f"📝 原因: {entry.get('reason') or '未填写'}\n"
+            "━━━━━━━━━━━━━━\n"
+        )
+    msg = await update.message.reply_text(message)
+    spawn_background(delete_message_later(msg, delay=60), "delete_message")
+
 async def unmute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理解除禁言命令"""
     if not await check_admin(update, context):
@@ -1027,15 +3287,6 @@ async def unmute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "操作": "解除禁言"
         }
         
-        # 保存到 Google Sheet
-        success = await sheets_storage.save_to_sheet(record)
-        if not success:
-            await message.reply_text("保存解除禁言记录失败")
-            return
-            
-        # 添加到内存中的记录列表
-        ban_records.append(record)
-        
         # 解除禁言
         await context.bot.restrict_chat_member(
             chat_id=chat.id,
@@ -1056,6 +3307,10 @@ async def unmute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             )
         )
         
+        # 记录交给后台写入，并添加到内存中的记录列表
+        moderation_events.publish(record)
+        mute_index.remove(chat.title, user.id)
+        
         # 发送确认消息
         await message.reply_text(
             f"✅ 已解除禁言用户 {user.first_name} (ID: {user.id})\n"
@@ -1066,11 +3321,77 @@ async def unmute_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"处理解除禁言命令时出错: {e}")
         await message.reply_text("处理解除禁言命令时出错")
 
+def keyword_reply_markup(reply: Dict[str, str]) -> Optional[InlineKeyboardMarkup]:
+    """关键词回复的链接按钮"""
+    if not reply.get("链接"):
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(reply.get("链接文本") or "点击这里", url=reply["链接"])]])
+
+async def keyword_inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """内联查询：按前缀自动补全关键词，返回可直接发送的回复（只读内存索引，不访问 Google Sheets）"""
+    inline_query = update.inline_query
+    results = []
+    for keyword in keyword_engine.prefixes.lookup(inline_query.query):
+        reply = reply_keywords.get(keyword)
+        if not reply:
+            continue
+        results.append(InlineQueryResultArticle(
+            id=str(keyword_engine.keyword_id(keyword)),
+            title=keyword,
+            description=str(reply["回复内容"])[:100],
+            input_message_content=InputTextMessageContent(str(reply["回复内容"])),
+            reply_markup=keyword_reply_markup(reply),
+        ))
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+async def keyword_auto_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """群组消息命中关键词时自动回复，受冷却和话题限制，短时间内的多次触发合并为一条回复"""
+    message = update.message
+    if not message or not message.text or not message.from_user or message.from_user.is_bot:
+        return
+    reply = keyword_engine.match(message.text)
+    if not reply:
+        return
+        
+    key = (message.chat_id, str(reply["关键词"]))
+    pending = pending_keyword_replies.get(key)
+    if pending is not None:
+        pending.append(message)
+        KEYWORD_REPLIES.labels(outcome="coalesced").inc()
+        return
+        
+    if message.reply_to_message:
+        thread_id = message.reply_to_message.message_id
+    else:
+        thread_id = message.message_thread_id if message.is_topic_message else None
+    if not keyword_throttle.allow(message.chat_id, key[1], thread_id, time_module.monotonic()):
+        KEYWORD_REPLIES.labels(outcome="throttled").inc()
+        return
+        
+    pending_keyword_replies[key] = [message]
+    spawn_background(send_keyword_reply(key, reply), "keyword_reply")
+
+async def send_keyword_reply(key: tuple, reply: Dict[str, str]) -> None:
+    """等待合并窗口结束后回复第一条触发消息"""
+    try:
+        await asyncio.sleep(KEYWORD_COALESCE_WINDOW)
+    finally:
+        messages = pending_keyword_replies.pop(key, [])
+    if not messages:
+        return
+    try:
+        await messages[0].reply_text(reply["回复内容"], reply_markup=keyword_reply_markup(reply))
+        KEYWORD_REPLIES.labels(outcome="sent").inc()
+        if len(messages) > 1:
+            logger.info(f"关键词 {key[1]} 在群组 {key[0]} 的 {len(messages)} 次触发合并为一条回复")
+    except Exception as e:
+        logger.error(f"发送关键词回复失败: {e}")
+
 async def keyword_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理关键词回复命令"""
     if not await check_admin(update, context):
         msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
-        asyncio.create_task(delete_message_later(msg))
+        spawn_background(delete_message_later(msg), "delete_message")
         return
 
     if not context.args:
@@ -1094,6 +3415,49 @@ async def keyword_reply_handler(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
+def keyword_menu(action: str, page: int) -> tuple:
+    """渲染关键词的修改/删除/列表菜单（分页），返回 (文本, 按钮)；关键词为空时按钮为 None"""
+    keywords = keyword_engine.sorted_keywords
+    if not keywords:
+        return "暂无关键词回复配置", None
+    pages = -(-len(keywords) // KEYWORD_MENU_PAGE)
+    page = min(max(page, 0), pages - 1)
+    current = keywords[page * KEYWORD_MENU_PAGE:(page + 1) * KEYWORD_MENU_PAGE]
+    
+    keyboard = []
+    if action == "list":
+        text = f"📋 关键词回复列表 ({len(keywords)} 个):\n\n"
+        for keyword in current:
+            reply = reply_keywords[keyword]
+            text += (
+                f"🔑 关键词: {keyword}\n"
+                f"💬 回复: {reply['回复内容']}\n"
+            )
+            if reply.get("链接"):
+                text += f"🔗 链接: {reply['链接']} ({reply.get('链接文本', '点击这里')})\n"
+            text += "━━━━━━━━━━━━━━\n"
+    else:
+        icon, target = ("🔑", "edit_keyword") if action == "edit" else ("🗑️", "delete_keyword")
+        text = (
+            "📝 修改关键词回复\n\n请选择要修改的关键词：" if action == "edit"
+            else "🗑️ 删除关键词回复\n\n请选择要删除的关键词："
+        )
+        for keyword in current:
+            keyboard.append([InlineKeyboardButton(
+                f"{icon} {keyword}", callback_data=f"reply:{target}:{keyword_engine.keyword_id(keyword)}"
+            )])
+    
+    if pages > 1:
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"reply:{action}:{page - 1}"))
+        navigation.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="reply:noop"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"reply:{action}:{page + 1}"))
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="reply:menu")])
+    return text, InlineKeyboardMarkup(keyboard)
+
 async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理关键词回复的回调"""
     query = update.callback_query
@@ -1111,7 +3475,11 @@ async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             await query.message.edit_text("❌ 无效的操作")
             return
             
-        if action == "add":
+        if action == "noop":
+            # 页码按钮，无需处理
+            return
+            
+        elif action == "add":
             # 开始添加流程
             context.user_data["reply_flow"] = {
                 "step": 1,
@@ -1124,75 +3492,11 @@ async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
                 "输入 /cancel 取消操作"
             )
             
-        elif action == "edit":
-            # 获取所有关键词
-            replies = await sheets_storage.get_keyword_replies()
-            if not replies:
-                await query.message.edit_text("暂无关键词回复可修改")
-                return
-                
-            # 创建关键词选择按钮
-            keyboard = []
-            for reply in replies:
-                keyboard.append([InlineKeyboardButton(
-                    f"🔑 {reply['关键词']}",
-                    callback_data=f"reply:edit_keyword:{reply['关键词']}"
-                )])
-                
-            keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="reply:menu")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.message.edit_text(
-                "📝 修改关键词回复\n\n"
-                "请选择要修改的关键词：",
-                reply_markup=reply_markup
-            )
-            
-        elif action == "delete":
-            # 获取所有关键词
-            replies = await sheets_storage.get_keyword_replies()
-            if not replies:
-                await query.message.edit_text("暂无关键词回复可删除")
-                return
-                
-            # 创建关键词选择按钮
-            keyboard = []
-            for reply in replies:
-                keyboard.append([InlineKeyboardButton(
-                    f"🗑️ {reply['关键词']}",
-                    callback_data=f"reply:delete_keyword:{reply['关键词']}"
-                )])
-                
-            keyboard.append([InlineKeyboardButton("🔙 返回", callback_data="reply:menu")])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.message.edit_text(
-                "🗑️ 删除关键词回复\n\n"
-                "请选择要删除的关键词：",
-                reply_markup=reply_markup
-            )
-            
-        elif action == "list":
-            replies = await sheets_storage.get_keyword_replies()
-            
-            if not replies:
-                await query.message.edit_text("暂无关键词回复配置")
-                return
-                
-            message = "📋 关键词回复列表:\n\n"
-            for reply in replies:
-                message += (
-                    f"🔑 关键词: {reply['关键词']}\n"
-                    f"💬 回复: {reply['回复内容']}\n"
-                )
-                if reply.get("链接"):
-                    message += f"🔗 链接: {reply['链接']} ({reply.get('链接文本', '点击这里')})\n"
-                message += "━━━━━━━━━━━━━━\n"
-                
-            keyboard = [[InlineKeyboardButton("🔙 返回", callback_data="reply:menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.message.edit_text(message, reply_markup=reply_markup)
+        elif action in ("edit", "delete", "list"):
+            # 菜单从缓存的关键词目录分页生成，回调数据只带页码
+            page = int(action_data[1]) if len(action_data) > 1 and action_data[1].isdigit() else 0
+            text, reply_markup = keyword_menu(action, page)
+            await query.message.edit_text(text, reply_markup=reply_markup)
             
         elif action == "menu":
             # 返回主菜单
@@ -1215,12 +3519,11 @@ async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             )
             
         elif action == "edit_keyword":
-            keyword = action_data[1] if len(action_data) > 1 else ""
-            replies = await sheets_storage.get_keyword_replies()
-            existing_reply = next((r for r in replies if r["关键词"] == keyword), None)
+            keyword = keyword_engine.keyword_for(action_data[1]) if len(action_data) > 1 else None
+            existing_reply = reply_keywords.get(keyword) if keyword else None
             
             if not existing_reply:
-                await query.message.edit_text(f"❌ 未找到关键词: {keyword}")
+                await query.message.edit_text("❌ 关键词不存在或已被删除")
                 return
                 
             # 开始修改流程
@@ -1241,12 +3544,15 @@ async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             )
             
         elif action == "delete_keyword":
-            keyword = action_data[1] if len(action_data) > 1 else ""
+            keyword = keyword_engine.keyword_for(action_data[1]) if len(action_data) > 1 else None
+            if not keyword:
+                await query.message.edit_text("❌ 关键词不存在或已被删除")
+                return
             
             # 创建确认按钮
             keyboard = [
                 [
-                    InlineKeyboardButton("✅ 确认删除", callback_data=f"reply:confirm_delete:{keyword}"),
+                    InlineKeyboardButton("✅ 确认删除", callback_data=f"reply:confirm_delete:{action_data[1]}"),
                     InlineKeyboardButton("❌ 取消", callback_data="reply:delete")
                 ]
             ]
@@ -1259,10 +3565,14 @@ async def reply_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             )
             
         elif action == "confirm_delete":
-            keyword = action_data[1] if len(action_data) > 1 else ""
+            keyword = keyword_engine.keyword_for(action_data[1]) if len(action_data) > 1 else None
+            if not keyword:
+                await query.message.edit_text("❌ 关键词不存在或已被删除")
+                return
             success = await sheets_storage.delete_keyword_reply(keyword)
             
             if success:
+                keyword_engine.remove(keyword)
                 await query.message.edit_text(f"✅ 已删除关键词回复: {keyword}")
             else:
                 await query.message.edit_text(f"❌ 删除失败: {keyword}")
@@ -1333,7 +3643,7 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "第2步：请回复此消息，输入回复内容\n"
                 "输入 /cancel 取消操作"
             )
-            asyncio.create_task(delete_message_later(sent_message, delay=300))
+            spawn_background(delete_message_later(sent_message, delay=300), "delete_message")
             
         elif flow["step"] == 2:
             # 第二步：获取回复内容
@@ -1350,7 +3660,7 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "直接回复 /skip 跳过此步\n"
                 "输入 /cancel 取消操作"
             )
-            asyncio.create_task(delete_message_later(sent_message, delay=300))
+            spawn_background(delete_message_later(sent_message, delay=300), "delete_message")
             
         elif flow["step"] == 3:
             # 第三步：获取链接信息
@@ -1376,6 +3686,7 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if flow["action"] == "edit":
                 # 修改时先删除旧的
                 await sheets_storage.delete_keyword_reply(flow["keyword"])
+                keyword_engine.remove(flow["keyword"])
             
             success = await sheets_storage.add_keyword_reply(
                 keyword=flow["keyword"],
@@ -1385,6 +3696,12 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
             if success:
+                keyword_engine.set({
+                    "关键词": flow["keyword"],
+                    "回复内容": flow["reply_text"],
+                    "链接": link,
+                    "链接文本": link_text
+                })
                 sent_message = await update.message.reply_text(
                     f"✅ 已{action_text}关键词回复:\n\n"
                     f"🔑 关键词: {flow['keyword']}\n"
@@ -1396,7 +3713,7 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 sent_message = await update.message.reply_text(f"❌ {action_text}关键词回复失败")
             
             # 设置定时删除消息
-            asyncio.create_task(delete_message_later(sent_message, delay=300))
+            spawn_background(delete_message_later(sent_message, delay=300), "delete_message")
             
             # 清理流程数据
             del context.user_data["reply_flow"]
@@ -1405,7 +3722,7 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in handle_reply_flow: {e}")
         sent_message = await update.message.reply_text("❌ 操作失败，请重试")
-        asyncio.create_task(delete_message_later(sent_message, delay=300))
+        spawn_background(delete_message_later(sent_message, delay=300), "delete_message")
         # 清理流程数据
         if "reply_flow" in context.user_data:
             del context.user_data["reply_flow"]
@@ -1413,99 +3730,364 @@ async def handle_reply_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def records_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """处理/records命令"""
+    """处理/records命令：/records 查看最近记录，/records 7d 查看最近一段时间内的记录"""
     if not await check_admin(update, context):
         msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
-        asyncio.create_task(delete_message_later(msg, delay=10))
+        spawn_background(delete_message_later(msg, delay=10), "delete_message")
         return
     
-    global ban_records
-    
     try:
         if not ban_records:
             msg = await update.message.reply_text("暂无封禁记录")
-            asyncio.create_task(delete_message_later(msg, delay=10))
+            spawn_background(delete_message_later(msg, delay=10), "delete_message")
             return
         
-        # 获取最近的记录
-        recent_records = sorted(ban_records, key=lambda x: x.get("操作时间", ""), reverse=True)[:MAX_RECORDS_DISPLAY]
-        
-        message = "📊 最近封禁记录:\n\n"
-        for record in recent_records:
-            record_time = datetime.fromisoformat(record["操作时间"]).astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M")
-            message += (
-                f"🕒 {record_time}\n"
-                f"👤 用户: {record.get('名称', '未知')} "
-                f"(ID: {record.get('用户ID', '未知')}) "
-                f"[{record.get('用户名', '无')}]\n"
-                f"👮 管理员: {record.get('操作管理', '未知')}\n"
-                f"📝 原因: {record.get('理由', '未填写')}\n"
-                f"💬 群组: {record.get('电报群组名称', '未知')}\n"
-                f"🔧 操作: {record.get('操作', '未知')}\n"
-                "━━━━━━━━━━━━━━\n"
-            )
+        if context.args:
+            duration = parse_duration(context.args[0])
+            if not duration:
+                msg = await update.message.reply_text("时间格式错误，例如: /records 7d 或 /records 12h")
+                spawn_background(delete_message_later(msg, delay=10), "delete_message")
+                return
+            record_ids = ban_records.between((datetime.now(TIMEZONE) - duration).timestamp())
+            if not record_ids:
+                msg = await update.message.reply_text(f"最近 {format_duration(duration)} 内暂无记录")
+                spawn_background(delete_message_later(msg, delay=10), "delete_message")
+                return
+            header = f"📊 最近 {format_duration(duration)} 的记录 (共 {len(record_ids)} 条: {summarize_actions(record_ids)}):\n\n"
+        else:
+            record_ids = ban_records.latest(MAX_CURSOR_RESULTS)
+            header = "📊 最近封禁记录:\n\n"
         
-        msg = await update.message.reply_text(message)
-        asyncio.create_task(delete_message_later(msg, delay=30))
+        # 记录ID已按时间从新到旧排列
+        await reply_paginated(update.message, header, record_ids, delay=30)
         
     except Exception as e:
         error_msg = await update.message.reply_text(f"❌ 获取记录失败: {str(e)}")
-        asyncio.create_task(delete_message_later(error_msg))
+        spawn_background(delete_message_later(error_msg), "delete_message")
         logger.error(f"获取封禁记录失败: {e}")
 
 async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理/search命令"""
     if not await check_admin(update, context):
         msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
-        asyncio.create_task(delete_message_later(msg))
+        spawn_background(delete_message_later(msg), "delete_message")
         return
 
     if not context.args:
-        msg = await update.message.reply_text("请输入搜索关键词，例如: /search 广告")
-        asyncio.create_task(delete_message_later(msg))
+        msg = await update.message.reply_text("请输入搜索关键词，例如: /search 广告 或 /search reason:广告 admin:张三")
+        spawn_background(delete_message_later(msg), "delete_message")
         return
 
     keyword = " ".join(context.args)
-    global ban_records
 
     try:
-        # 在内存中搜索记录
-        matched_records = [
-            record for record in ban_records
-            if keyword.lower() in record.get("理由", "").lower() or
-               keyword.lower() in record.get("名称", "").lower() or
-               keyword.lower() in record.get("用户名", "").lower() or
-               keyword.lower() in record.get("电报群组名称", "").lower()
-        ]
+        # 通过倒排索引搜索，支持 reason:理由 admin:管理员 等字段过滤
+        record_ids = record_index.search(keyword, ban_records, limit=MAX_CURSOR_RESULTS)
 
-        if not matched_records:
+        if not record_ids:
             msg = await update.message.reply_text("未找到匹配的封禁记录")
-            asyncio.create_task(delete_message_later(msg, delay=10))
+            spawn_background(delete_message_later(msg, delay=10), "delete_message")
             return
 
-        message = f"🔍 搜索结果 (关键词: {keyword}):\n\n"
-        for record in matched_records[:MAX_RECORDS_DISPLAY]:
-            record_time = datetime.fromisoformat(record["操作时间"]).astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M")
-            message += (
-                f"🕒 {record_time}\n"
-                f"👤 用户: {record.get('名称', '未知')} "
-                f"(ID: {record.get('用户ID', '未知')}) "
-                f"[{record.get('用户名', '无')}]\n"
-                f"👮 管理员: {record.get('操作管理', '未知')}\n"
-                f"📝 原因: {record.get('理由', '未填写')}\n"
-                f"💬 群组: {record.get('电报群组名称', '未知')}\n"
-                f"🔧 操作: {record.get('操作', '未知')}\n"
-                "━━━━━━━━━━━━━━\n"
-            )
-
-        msg = await update.message.reply_text(message)
-        asyncio.create_task(delete_message_later(msg, delay=60))
+        await reply_paginated(update.message, f"🔍 搜索结果 (关键词: {keyword}, 共 {len(record_ids)} 条):\n\n", record_ids)
 
     except Exception as e:
         error_msg = await update.message.reply_text(f"❌ 搜索失败: {str(e)}")
-        asyncio.create_task(delete_message_later(error_msg))
+        spawn_background(delete_message_later(error_msg), "delete_message")
         logger.error(f"搜索封禁记录失败: {e}")
 
+async def history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """查询用户的历史处理记录：/history <用户ID|@用户名>，或回复该用户的消息"""
+    if not await check_admin(update, context):
+        msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
+        spawn_background(delete_message_later(msg), "delete_message")
+        return
+        
+    message = update.message
+    if context.args:
+        target = context.args[0]
+    elif message.reply_to_message and message.reply_to_message.from_user:
+        target = str(message.reply_to_message.from_user.id)
+    else:
+        msg = await message.reply_text("用法: /history <用户ID|@用户名>，或回复该用户的消息发送 /history")
+        spawn_background(delete_message_later(msg), "delete_message")
+        return
+        
+    if target.lstrip("-").isdigit():
+        record_ids = list(record_lookup.get("user", target))
+    else:
+        # 用户名先通过搜索索引找到对应的用户ID，再汇总这些用户的全部记录
+        username = "@" + target.lstrip("@")
+        user_ids = {
+            ban_records[record_id].get("用户ID")
+            for record_id in record_index.values["username"].get(username.lower(), ())
+        }
+        record_ids = [record_id for uid in user_ids for record_id in record_lookup.get("user", uid)]
+        
+    if not record_ids:
+        msg = await message.reply_text(f"未找到 {target} 的历史记录")
+        spawn_background(delete_message_later(msg, delay=10), "delete_message")
+        return
+        
+    header = f"📜 {target} 的历史记录 (共 {len(record_ids)} 条: {summarize_actions(record_ids)}):\n\n"
+    await reply_paginated(message, header, newest_first(record_ids))
+
+async def byadmin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """查询管理员的操作记录：/byadmin <管理员名称>"""
+    if not await check_admin(update, context):
+        msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
+        spawn_background(delete_message_later(msg), "delete_message")
+        return
+        
+    if not context.args:
+        msg = await update.message.reply_text("用法: /byadmin <管理员名称>")
+        spawn_background(delete_message_later(msg), "delete_message")
+        return
+        
+    name = " ".join(context.args)
+    keys = record_lookup.find_keys("admin", name)
+    if not keys:
+        msg = await update.message.reply_text(f"未找到管理员 {name} 的操作记录")
+        spawn_background(delete_message_later(msg, delay=10), "delete_message")
+        return
+        
+    record_ids = [record_id for key in keys for record_id in record_lookup.get("admin", key)]
+    admins = "、".join(ban_records[newest_first(record_lookup.get("admin", key))[0]].get("操作管理", key) for key in keys[:5])
+    reasons = collections.Counter(ban_records[record_id].get("理由", "") or "未填写" for record_id in record_ids)
+    header = (
+        f"👮 {admins} 的操作记录 (共 {len(record_ids)} 条: {summarize_actions(record_ids)})\n"
+        f"📝 常见理由: {'、'.join(f'{reason} {count}' for reason, count in reasons.most_common(5))}\n\n"
+    )
+    await reply_paginated(update.message, header, newest_first(record_ids))
+
+def format_stats(summary: Dict[str, Any]) -> str:
+    """格式化 /stats 的统计结果"""
+    def trend(action: str) -> str:
+        current = summary["totals"].get(action, 0)
+        previous = summary["previous_totals"].get(action, 0)
+        if not previous:
+            return f"{current}"
+        return f"{current}（上期 {previous}，{(current - previous) * 100 / previous:+.0f}%）"
+    
+    actions = sorted(set(summary["totals"]) | set(summary["previous_totals"]), key=lambda a: -summary["totals"].get(a, 0))
+    text = f"📈 最近 {summary['days']} 天处理统计 ({summary['from']} ~ {summary['to']})\n\n"
+    text += "\n".join(f"🔧 {action}: {trend(action)}" for action in actions) or "暂无记录"
+    text += "\n\n📅 每日:\n"
+    for day, counts in summary["daily"].items():
+        if counts:
+            text += f"{day[5:]}: " + " / ".join(f"{action} {count}" for action, count in sorted(counts.items())) + "\n"
+    labels = {"reason": "📝 理由", "admin": "👮 管理员", "group": "💬 群组"}
+    for dimension, label in labels.items():
+        top = summary["top"][dimension]
+        if top:
+            text += f"\n{label} TOP{len(top)}: " + "、".join(f"{key} {count}" for key, count in top)
+    return text
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理/stats命令：/stats [时长]，默认最近7天"""
+    if not await check_admin(update, context):
+        msg = await update.message.reply_text("❌ 只有管理员可以使用此命令")
+        spawn_background(delete_message_later(msg), "delete_message")
+        return
+        
+    days = 7
+    if context.args:
+        duration = parse_duration(context.args[0])
+        if not duration:
+            msg = await update.message.reply_text("时间格式错误，例如: /stats 7d 或 /stats 4w")
+            spawn_background(delete_message_later(msg, delay=10), "delete_message")
+            return
+        days = min(max(1, -(-int(duration.total_seconds()) // 86400)), 366)
+        
+    msg = await update.message.reply_text(format_stats(moderation_stats.summary(days)))
+    spawn_background(delete_message_later(msg, delay=60), "delete_message")
+
+async def page_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """翻页：从游标中取出缓存的结果直接编辑消息，不重新查询"""
+    query = update.callback_query
+    if not await check_admin(update, context):
+        await query.answer("❌ 只有管理员可以翻页", show_alert=True)
+        return
+        
+    parts = query.data.split("|")
+    if len(parts) != 3 or not parts[2].isdigit():
+        await query.answer()  # 页码按钮
+        return
+        
+    cursor, page = parts[1], int(parts[2])
+    entry = query_cursors.get(cursor)
+    if not entry:
+        await query.answer("结果已过期，请重新查询", show_alert=True)
+        return
+        
+    header, record_ids = entry
+    text, reply_markup = render_page(cursor, header, record_ids, page)
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+EXPORT_HEADERS = list(BanRecord.COLUMNS)
+EXPORT_FILTERS = {"group": "chat", "chat": "chat", "reason": "reason", "admin": "operator"}
+
+def parse_export_args(args: List[str]) -> tuple:
+    """解析 /export ban 的参数，返回 (格式, 过滤条件)
+
+    支持 csv|xlsx、时长（如 7d）、from:2024-01-01、to:2024-02-01、group:群组、reason:理由、admin:管理员；
+    参数无效时抛出 ValueError。
+    """
+    fmt = "csv"
+    filters = {}
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        key = key.lower()
+        if not sep and key in ("csv", "xlsx"):
+            fmt = key
+        elif not sep:
+            duration = parse_duration(arg)
+            if not duration:
+                raise ValueError(f"无法识别的参数: {arg}")
+            filters["since"] = (datetime.now(TIMEZONE) - duration).timestamp()
+        elif key in ("from", "to"):
+            day = parse_record_time(value)
+            if not day:
+                raise ValueError(f"日期格式错误: {value}，例如 2024-01-31")
+            if key == "to" and len(value) <= 10:
+                day += timedelta(days=1)  # 只给日期时包含当天
+            filters["since" if key == "from" else "until"] = day.timestamp()
+        elif key in EXPORT_FILTERS and value:
+            filters[EXPORT_FILTERS[key]] = value.lower()
+        else:
+            raise ValueError(f"无法识别的参数: {arg}")
+    return fmt, filters
+
+def select_export_records(filters: Dict[str, Any]) -> List[int]:
+    """按过滤条件选出记录ID，按时间从旧到新排列"""
+    if "since" in filters or "until" in filters:
+        record_ids = ban_records.between(filters.get("since", 0.0), filters.get("until"))[::-1]
+    else:
+        record_ids = ban_records.order_ids.tolist()
+    for attr in ("chat", "reason", "operator"):
+        if attr in filters:
+            text = filters[attr]
+            record_ids = [
+                record_id for record_id in record_ids
+                if text in getattr(ban_records[record_id], attr).lower()
+            ]
+    return record_ids
+
+def write_export(rows, fmt: str, compress: bool, directory: str, stem: str) -> List[str]:
+    """将记录行流式写入 directory 下的一个或多个文件，返回文件路径
+
+    CSV 超过 EXPORT_PART_BYTES（压缩后大小）、XLSX 超过 EXPORT_XLSX_ROWS 行时自动分卷，每卷都带表头。
+    """
+    paths = []
+    
+    def next_path(suffix: str) -> str:
+        paths.append(os.path.join(directory, f"{stem}_{len(paths) + 1}{suffix}"))
+        return paths[-1]
+    
+    if fmt == "xlsx":
+        workbook = sheet = None
+        for index, row in enumerate(rows):
+            if index % EXPORT_XLSX_ROWS == 0:
+                if workbook:
+                    workbook.save(paths[-1])
+                next_path(".xlsx")
+                workbook = Workbook(write_only=True)
+                sheet = workbook.create_sheet("封禁记录")
+                sheet.append(EXPORT_HEADERS)
+            sheet.append(row)
+        if workbook:
+            workbook.save(paths[-1])
+    else:
+        raw = text = writer = None
+        for row in rows:
+            if writer is None or raw.tell() >= EXPORT_PART_BYTES:
+                if text:
+                    text.close()
+                    raw.close()
+                raw = open(next_path(".csv.gz" if compress else ".csv"), "wb")
+                handle = gzip.GzipFile(fileobj=raw, mode="wb") if compress else raw
+                # 带 BOM，Excel 打开中文不乱码
+                text = io.TextIOWrapper(handle, encoding="utf-8-sig", newline="")
+                writer = csv.writer(text)
+                writer.writerow(EXPORT_HEADERS)
+            writer.writerow(row)
+        if text:
+            text.close()
+            raw.close()
+    
+    if len(paths) == 1:
+        single = paths[0].replace(f"{stem}_1", stem)
+        os.replace(paths[0], single)
+        paths[0] = single
+    return paths
+
+class ExportCache:
+    """最近导出文件的 Telegram file_id，记录和过滤条件都没变时直接重发，不再生成和上传"""
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # (格式, 过滤条件, 记录版本) -> [(file_id, 文件名)]
+
+    @staticmethod
+    def key(fmt: str, filters: Dict[str, Any]) -> tuple:
+        # 相对时长每次都会得到不同的时间戳，按分钟取整以便命中
+        normalized = tuple(sorted(
+            (name, int(value // 60) if name in ("since", "until") else value) for name, value in filters.items()
+        ))
+        return fmt, normalized, ban_records.version
+
+    def get(self, key: tuple) -> Optional[List[tuple]]:
+        files = self.entries.get(key)
+        if files:
+            self.entries.move_to_end(key)
+        return files
+
+    def put(self, key: tuple, files: List[tuple]) -> None:
+        self.entries[key] = files
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+export_cache = ExportCache()
+
+async def export_ban_records(message, args: List[str]) -> None:
+    """导出封禁记录：/export ban [csv|xlsx] [7d] [from:日期] [to:日期] [group:群组] [reason:理由] [admin:管理员]"""
+    try:
+        fmt, filters = parse_export_args(args)
+    except ValueError as e:
+        await message.reply_text(f"❌ {e}")
+        return
+        
+    key = export_cache.key(fmt, filters)
+    cached = export_cache.get(key)
+    if cached:
+        for file_id, filename in cached:
+            await message.reply_document(document=file_id, caption=f"{filename}（缓存）")
+        return
+        
+    record_ids = select_export_records(filters)
+    if not record_ids:
+        await message.reply_text("没有符合条件的封禁记录")
+        return
+        
+    compress = fmt == "csv" and len(record_ids) > EXPORT_GZIP_ROWS
+    stem = f"{os.path.splitext(EXCEL_FILE)[0]}_{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}"
+    # 在线程中边取记录行边写文件，不在内存中堆积全部行，事件循环始终可以处理其他命令
+    rows = (GoogleSheetsStorage._record_row(ban_records[record_id]) for record_id in record_ids)
+    sent = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = await asyncio.to_thread(write_export, rows, fmt, compress, directory, stem)
+        for index, path in enumerate(paths, 1):
+            filename = os.path.basename(path)
+            caption = f"共 {len(record_ids)} 条记录" + (f"，第 {index}/{len(paths)} 部分" if len(paths) > 1 else "")
+            with open(path, "rb") as document:
+                msg = await message.reply_document(
+                    document=document, filename=filename, caption=caption, write_timeout=300
+                )
+            sent.append((msg.document.file_id, filename))
+    export_cache.put(key, sent)
+
 async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """导出数据"""
     if not await check_admin(update, context):
@@ -1516,7 +4098,7 @@ async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if not context.args:
             await update.message.reply_text(
                 "请指定要导出的数据类型：\n"
-                "/export ban - 导出封禁记录\n"
+                "/export ban [csv|xlsx] [7d] [from:日期] [to:日期] [group:群组] [reason:理由] [admin:管理员] - 导出封禁记录\n"
                 "/export rank - 导出排行榜数据"
             )
             return
@@ -1528,17 +4110,7 @@ async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if not ban_records:
                 await update.message.reply_text("暂无封禁记录")
                 return
-                
-            # 创建 CSV 文件
-            csv_data = "操作时间,电报群组名称,用户ID,用户名,名称,操作管理,理由,操作\n"
-            for record in ban_records:
-                csv_data += f"{record['操作时间']},{record['电报群组名称']},{record['用户ID']},{record['用户名']},{record['名称']},{record['操作管理']},{record['理由']},{record['操作']}\n"
-                
-            # 发送文件
-            await update.message.reply_document(
-                document=BytesIO(csv_data.encode()),
-                filename=f"ban_records_{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}.csv"
-            )
+            await export_ban_records(update.message, context.args[1:])
             
         elif export_type == "rank":
             # 导出排行榜数据
@@ -1552,12 +4124,14 @@ async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     await update.message.reply_text("暂无排行榜数据")
                     return
                 # 创建 CSV 文件
-                csv_data = "排名,用户名,积分,用户ID,记录时间\n"
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(["排名", "用户名", "积分", "用户ID", "记录时间"])
                 for record in rank_data:
                     # 使用 record.get() 方法获取字段值，避免 KeyError
-                    csv_data += f"{record.get('741', '')},{record.get('stonks起飞', '')},{record.get('4', '')},{record.get('未知', '')},{record.get('2025-06-07 20:03:59', '')}\n"
+                    writer.writerow([record.get('741', ''), record.get('stonks起飞', ''), record.get('4', ''), record.get('未知', ''), record.get('2025-06-07 20:03:59', '')])
                 await update.message.reply_document(
-                    document=BytesIO(csv_data.encode()),
+                    document=BytesIO(buffer.getvalue().encode("utf-8-sig")),
                     filename=f"rank_data_{datetime.now(TIMEZONE).strftime('%Y%m%d_%H%M%S')}.csv"
                 )
             except Exception as e:
@@ -1567,7 +4141,7 @@ async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             await update.message.reply_text(
                 "无效的导出类型。请使用：\n"
-                "/export ban - 导出封禁记录\n"
+                "/export ban [csv|xlsx] [7d] [from:日期] [to:日期] [group:群组] [reason:理由] [admin:管理员] - 导出封禁记录\n"
                 "/export rank - 导出排行榜数据"
             )
             
@@ -1694,7 +4268,7 @@ async def morning_greeting_handler(update: Update, context: ContextTypes.DEFAULT
         reply += "\n\n🎁 彩蛋：你是今天第{}个说早安的天使~".format(random.randint(1,100))
     sent_message = await update.message.reply_text(reply)
     logger.info(f"🌅 向 {user.full_name} 发送了早安问候")
-    asyncio.create_task(delete_message_later(sent_message, delay=300))  # 改为5分钟
+    spawn_background(delete_message_later(sent_message, delay=300), "delete_message")  # 改为5分钟
 
 async def noon_greeting_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理午安问候"""
@@ -1821,7 +4395,7 @@ async def noon_greeting_handler(update: Update, context: ContextTypes.DEFAULT_TY
     
     sent_message = await update.message.reply_text(reply)
     logger.info(f"☀️ 向 {user.full_name} 发送了午安问候")
-    asyncio.create_task(delete_message_later(sent_message, delay=300))  # 改为5分钟
+    spawn_background(delete_message_later(sent_message, delay=300), "delete_message")  # 改为5分钟
 
 async def goodnight_greeting_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理晚安问候"""
@@ -1891,7 +4465,7 @@ async def goodnight_greeting_handler(update: Update, context: ContextTypes.DEFAU
     
     sent_message = await update.message.reply_text(reply)
     logger.info(f"🌙 向 {user.full_name} 发送了晚安问候")
-    asyncio.create_task(delete_message_later(sent_message, delay=300))  # 改为5分钟
+    spawn_background(delete_message_later(sent_message, delay=300), "delete_message")  # 改为5分钟
 
 
 
@@ -1945,7 +4519,12 @@ async def handle_ai_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 4. 如果涉及专业术语，用简单的话解释"""
         
         # 生成回复
-        response = model.generate_content(prompt)
+        try:
+            with GEMINI_LATENCY.time(), tracer.span("gemini.generate_content"):
+                response = model.generate_content(prompt)
+        except Exception:
+            GEMINI_ERRORS.inc()
+            raise
         
         # 保存对话历史
         ai_conversations[chat_id].append({
@@ -2022,11 +4601,26 @@ async def unban_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
         user_id = int(context.args[0])
         
-        # 解除封禁
+        # 解除封禁，成功后才移出联邦封禁名单
         await context.bot.unban_chat_member(
             chat_id=update.effective_chat.id,
             user_id=user_id
         )
+        federated_banned_ids.discard(user_id)
+        
+        # 沿用该用户最近一条记录中的名称
+        history = record_lookup.get("user", user_id)
+        last = ban_records[newest_first(history)[0]] if history else {}
+        moderation_events.publish({
+            "操作时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"),
+            "电报群组名称": update.effective_chat.title,
+            "用户ID": user_id,
+            "用户名": last.get("用户名", "无"),
+            "名称": last.get("名称", ""),
+            "操作管理": update.effective_user.full_name,
+            "理由": "",
+            "操作": "解除封禁"
+        })
         
         # 发送成功消息
         await context.bot.send_message(
@@ -2083,6 +4677,27 @@ async def clear_rank_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.exception(e)
         await update.message.reply_text("❌ 清空排行榜数据失败")
 
+RANK_LINE = re.compile(r'(\d+)\.\s+([^\d]+)\s+(\d+)\s+测试积分')
+
+def parse_rank_text(rank_text: str, recorded_at: str) -> List[Dict[str, str]]:
+    """解析排行榜文本，每行格式：序号. 用户名 积分 测试积分"""
+    rank_data = []
+    for line in rank_text.split('\n'):
+        # 跳过空行
+        if not line.strip():
+            continue
+        match = RANK_LINE.match(line)
+        if match:
+            rank_data.append({
+                "排名": match.group(1),
+                "用户名": match.group(2).strip(),
+                "积分": match.group(3),
+                # 直接使用"未知"作为用户ID，避免不必要的API调用
+                "用户ID": "未知",
+                "记录时间": recorded_at
+            })
+    return rank_data
+
 async def rank_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理排行榜数据"""
     if not await check_admin(update, context):
@@ -2096,28 +4711,8 @@ async def rank_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             return
         # 获取被回复的消息文本
         rank_text = update.message.reply_to_message.text
-        # 解析排行榜数据
-        rank_data = []
-        for line in rank_text.split('\n'):
-            # 跳过空行
-            if not line.strip():
-                continue
-            # 尝试匹配格式：序号. 用户名 积分 测试积分
-            import re
-            match = re.match(r'(\d+)\.\s+([^\d]+)\s+(\d+)\s+测试积分', line)
-            if match:
-                rank = match.group(1)
-                username = match.group(2).strip()
-                points = match.group(3)
-                # 直接使用"未知"作为用户ID，避免不必要的API调用
-                user_id = "未知"
-                rank_data.append({
-                    "排名": rank,
-                    "用户名": username,
-                    "积分": points,
-                    "用户ID": user_id,
-                    "记录时间": datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
-                })
+        # 解析排行榜数据（在进程池中执行，长消息不会阻塞事件循环）
+        rank_data = await run_cpu_job(parse_rank_text, rank_text, datetime.now(TIMEZONE).strftime("%Y-%m-%d %H:%M:%S"))
         if not rank_data:
             await update.message.reply_text(
                 "未找到有效的排行榜数据。\n"
@@ -2139,23 +4734,31 @@ async def rank_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
-    global bot_app, bot_initialized, ban_records
+    global bot_app, bot_initialized
     
     try:
         # 初始化 Telegram Bot
         bot_app = (
             ApplicationBuilder()
             .token(TOKEN)
+            .request(MeteredRequest(connection_pool_size=256))
             .build()
         )
         
         # 添加命令处理器
         bot_app.add_handler(CommandHandler("start", start_handler))
         bot_app.add_handler(CommandHandler("k", ban_handler))
+        bot_app.add_handler(CommandHandler("kb", batch_ban_handler))
+        bot_app.add_handler(CommandHandler("fed", federation_handler))
+        bot_app.add_handler(CommandHandler("spamreload", spam_reload_handler))
         bot_app.add_handler(CommandHandler("m", mute_handler))
         bot_app.add_handler(CommandHandler("um", unmute_handler))
+        bot_app.add_handler(CommandHandler("mutes", mutes_handler))
         bot_app.add_handler(CommandHandler("records", records_handler))
         bot_app.add_handler(CommandHandler("search", search_handler))
+        bot_app.add_handler(CommandHandler("history", history_handler))
+        bot_app.add_handler(CommandHandler("byadmin", byadmin_handler))
+        bot_app.add_handler(CommandHandler("stats", stats_handler))
         bot_app.add_handler(CommandHandler("export", export_handler))
         bot_app.add_handler(CommandHandler("reply", keyword_reply_handler))
         bot_app.add_handler(CommandHandler("morning", morning_greeting_handler))
@@ -2171,18 +4774,66 @@ async def lifespan(app: FastAPI):
         bot_app.add_handler(CallbackQueryHandler(ban_reason_handler, pattern="^ban_reason"))
         bot_app.add_handler(CallbackQueryHandler(mute_reason_handler, pattern="^mute_reason"))
         bot_app.add_handler(CallbackQueryHandler(reply_callback_handler, pattern="^reply:"))
+        bot_app.add_handler(CallbackQueryHandler(duplicate_callback_handler, pattern="^dup:"))
+        bot_app.add_handler(CallbackQueryHandler(page_callback_handler, pattern="^page\\|"))
         
         # 处理所有文本消息 - 调整顺序，确保回复消息优先处理
         bot_app.add_handler(MessageHandler(filters.TEXT & filters.REPLY, message_handler))
         
+        # 跟踪机器人担任管理员的群组
+        bot_app.add_handler(ChatMemberHandler(my_chat_member_handler, ChatMemberHandler.MY_CHAT_MEMBER))
+        
+        # 跟踪新成员加入（启动时设置 webhook 的 allowed_updates 包含 chat_member）
+        bot_app.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.CHAT_MEMBER))
+        
+        # 记录群组消息（单独分组，不影响其他处理器）
+        bot_app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, track_group_message), group=-1)
+        
+        # 分组编号小的先执行：垃圾消息规则 -> 刷屏 -> 相似消息 -> 记录消息，处理了消息的检测会终止后续处理器
+        # 垃圾消息规则扫描（最先执行）
+        spam_filter.load()
+        bot_app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, spam_filter_handler), group=-4)
+        
+        # 刷屏检测
+        bot_app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, flood_handler), group=-3)
+        
+        # 相似消息检测
+        bot_app.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, duplicate_handler), group=-2)
+        # 关键词自动回复在命令和回复处理之后执行
+        bot_app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, keyword_auto_reply_handler), group=1)
+        # 内联查询关键词回复（需在 BotFather 中开启 inline 模式）
+        bot_app.add_handler(InlineQueryHandler(keyword_inline_query_handler))
+        
+        # 为所有处理器添加耗时统计
+        for group_handlers in bot_app.handlers.values():
+            for handler in group_handlers:
+                handler.callback = track_handler(handler.callback)
+        
         # 尝试从 Google Sheet 加载数据
         try:
-            ban_records = await sheets_storage.load_from_sheet()
+            ban_records.load(await sheets_storage.load_from_sheet())
             logger.info("成功从 Google Sheets 加载数据")
+            # 按时间顺序回放，只有经联邦同步过的封禁进入名单，解除封禁的用户不再留在名单中
+            for record_id in ban_records.order_ids:
+                record = ban_records[record_id]
+                if not isinstance(record.user_id, int):
+                    continue
+                if record.action == "联邦封禁":
+                    federated_banned_ids.add(record.user_id)
+                elif record.action == "解除封禁":
+                    federated_banned_ids.discard(record.user_id)
         except Exception as e:
             logger.error(f"Google Sheets 连接失败: {e}")
-            ban_records = []  # 使用空列表作为默认值
+            ban_records.load([])  # 使用空记录作为默认值
             logger.warning("将使用内存存储，部分功能可能受限")
+        record_index.rebuild(ban_records)
+        record_lookup.rebuild(ban_records)
+        moderation_stats.rebuild(ban_records)
+        try:
+            await keyword_engine.reload()
+        except Exception as e:
+            logger.error(f"加载关键词回复失败: {e}")
+            keyword_engine.compile()  # 使用空的关键词目录
         
         # 启动 bot
         await bot_app.initialize()
@@ -2190,6 +4841,23 @@ async def lifespan(app: FastAPI):
         bot_initialized = True
         logger.info("Bot 已成功启动")
         
+        # 注册 webhook，chat_member 更新需要在 allowed_updates 中显式订阅
+        if WEBHOOK_URL:
+            try:
+                await bot_app.bot.set_webhook(WEBHOOK_URL, allowed_updates=Update.ALL_TYPES)
+                logger.info(f"已设置 webhook: {WEBHOOK_URL}")
+            except Exception as e:
+                logger.error(f"设置 webhook 失败: {e}")
+        
+        # 启动事件循环延迟监控、后台记录写入、进程池和禁言到期调度
+        loop_watchdog.start()
+        record_writer.start()
+        cpu_pool.start()
+        mute_index.rebuild(ban_records)
+        mute_index.start(bot_app.bot)
+        if OTLP_TRACES_ENDPOINT:
+            tracer.start_exporter(OTLP_TRACES_ENDPOINT)
+        
         yield
         
     except Exception as e:
@@ -2197,6 +4865,11 @@ async def lifespan(app: FastAPI):
         logger.exception(e)
         raise
     finally:
+        loop_watchdog.stop()
+        tracer.stop_exporter()
+        mute_index.stop()
+        cpu_pool.stop()
+        await record_writer.stop()
         if bot_initialized:
             try:
                 await bot_app.stop()
@@ -2217,9 +4890,12 @@ async def telegram_webhook(request: Request):
     try:
         data = await request.json()
         update = Update.de_json(data, bot_app.bot)
-        await bot_app.process_update(update)
+        with tracer.span("update", update_id=update.update_id):
+            await bot_app.process_update(update)
+        UPDATES_TOTAL.labels(status="ok").inc()
         return {"ok": True}
     except Exception as e:
+        UPDATES_TOTAL.labels(status="error").inc()
         logger.error(f"Error processing webhook: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2240,5 +4916,217 @@ async def health_check():
         "timestamp": datetime.now(TIMEZONE).isoformat()
     }
 
+# 添加 Prometheus 指标路由
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 指标"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def require_admin_token(request: Request) -> None:
+    """校验调试接口的管理员令牌"""
+    if not ADMIN_API_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+class StackSampler:
+    """采样式 CPU 分析器，定期读取目标线程的调用栈"""
+    def __init__(self, thread_id: int, interval: float = 0.01):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def run(self, duration: float) -> None:
+        """在独立线程中运行，持续 duration 秒"""
+        deadline = time_module.monotonic() + duration
+        while time_module.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+            time_module.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        """火焰图折叠栈格式（flamegraph.pl / speedscope 可直接读取）"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """按自身耗时排序的函数列表"""
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            self_counts[stack[-1]] += count
+            for label in set(stack):
+                total_counts[label] += count
+        return [
+            {
+                "function": label,
+                "self": count,
+                "total": total_counts[label],
+                "self_pct": round(count * 100 / self.samples, 2) if self.samples else 0,
+            }
+            for label, count in self_counts.most_common(limit)
+        ]
+
+profile_lock = asyncio.Lock()
+
+# 添加 CPU 分析路由
+@app.get("/debug/profile")
+async def profile(request: Request, seconds: float = 10, interval_ms: float = 10, format: str = "json"):
+    """对运行中的进程进行限时采样分析"""
+    require_admin_token(request)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="Profile already running")
+    seconds = min(max(seconds, 1), 60)
+    interval_ms = min(max(interval_ms, 1), 100)
+
+    async with profile_lock:
+        # 路由运行在事件循环线程中，对该线程采样
+        sampler = StackSampler(threading.get_ident(), interval_ms / 1000)
+        await asyncio.to_thread(sampler.run, seconds)
+
+    if format == "collapsed":
+        return PlainTextResponse(sampler.collapsed())
+    return {
+        "seconds": seconds,
+        "interval_ms": interval_ms,
+        "samples": sampler.samples,
+        "top": sampler.top_functions(),
+        "collapsed": sampler.collapsed(),
+    }
+
+# 添加追踪查询路由
+@app.get("/debug/traces")
+async def traces(request: Request, limit: int = 20, min_ms: float = 0):
+    """最近的更新追踪（JSON）"""
+    require_admin_token(request)
+    return {"traces": tracer.recent(min(max(limit, 1), 200), min_ms)}
+
+memory_snapshots = collections.OrderedDict()  # 快照ID -> tracemalloc 快照
+MAX_MEMORY_SNAPSHOTS = 5
+
+def _format_stats(stats, limit: int) -> List[Dict[str, Any]]:
+    """将 tracemalloc 统计转换为 JSON"""
+    result = []
+    for stat in stats[:limit]:
+        item = {
+            "location": str(stat.traceback),
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        if hasattr(stat, "size_diff"):
+            item["size_diff_kb"] = round(stat.size_diff / 1024, 1)
+            item["count_diff"] = stat.count_diff
+        result.append(item)
+    return result
+
+def _deep_sizeof(obj, seen=None) -> int:
+    """估算对象及其包含对象的总大小"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, BanRecord):
+        size += sum(_deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__)
+    elif isinstance(obj, RecordStore):
+        size += _deep_sizeof(vars(obj), seen)
+    return size
+
+# 添加内存分析路由
+@app.post("/debug/memory/snapshot")
+async def memory_snapshot(request: Request, frames: int = 1, limit: int = 20):
+    """拍摄 tracemalloc 快照，首次调用时开启跟踪"""
+    require_admin_token(request)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(min(max(frames, 1), 25))
+        logger.info("已开启 tracemalloc 内存跟踪")
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    snapshot_id = uuid.uuid4().hex[:8]
+    memory_snapshots[snapshot_id] = snapshot
+    while len(memory_snapshots) > MAX_MEMORY_SNAPSHOTS:
+        memory_snapshots.popitem(last=False)
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "id": snapshot_id,
+        "snapshots": list(memory_snapshots),
+        "traced_kb": round(current / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+        "top": _format_stats(snapshot.statistics("lineno"), limit),
+    }
+
+@app.get("/debug/memory/diff")
+async def memory_diff(request: Request, base: str, target: Optional[str] = None, limit: int = 20):
+    """比较两个快照，默认比较 base 与最新的快照"""
+    require_admin_token(request)
+    target = target or next(reversed(memory_snapshots), None)
+    if base not in memory_snapshots or target not in memory_snapshots:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    stats = memory_snapshots[target].compare_to(memory_snapshots[base], "lineno")
+    return {
+        "base": base,
+        "target": target,
+        "size_diff_kb": round(sum(stat.size_diff for stat in stats) / 1024, 1),
+        "top": _format_stats(stats, limit),
+    }
+
+@app.post("/debug/memory/stop")
+async def memory_stop(request: Request):
+    """停止 tracemalloc 跟踪并丢弃快照"""
+    require_admin_token(request)
+    memory_snapshots.clear()
+    tracemalloc.stop()
+    return {"tracing": False}
+
+@app.get("/debug/memory/structures")
+async def memory_structures(request: Request, deep: bool = False):
+    """已知全局结构的大小"""
+    require_admin_token(request)
+    structures = {
+        "ban_records": ban_records,
+        "ai_conversations": ai_conversations,
+    }
+    if bot_app:
+        structures["chat_data"] = dict(bot_app.chat_data)
+        structures["user_data"] = dict(bot_app.user_data)
+
+    result = {name: {"entries": len(value)} for name, value in structures.items()}
+    result["ai_conversations"]["turns"] = sum(len(turns) for turns in ai_conversations.values())
+    result["background_tasks"] = dict(collections.Counter(task.get_name() for task in background_tasks))
+    if deep:
+        # 遍历大结构耗时较长，放到线程中计算，不阻塞处理 webhook 的事件循环
+        for name, value in structures.items():
+            try:
+                result[name]["approx_kb"] = round(await asyncio.to_thread(_deep_sizeof, value) / 1024, 1)
+            except RuntimeError as e:  # 计算期间结构被修改
+                result[name]["approx_kb"] = None
+                logger.warning(f"估算 {name} 大小失败: {e}")
+    return result
+
+# 添加处理统计路由
+@app.get("/admin/stats")
+async def admin_stats(request: Request, days: int = 7, top: int = 10):
+    """处理统计（与 /stats 命令相同的数据）"""
+    require_admin_token(request)
+    return moderation_stats.summary(min(max(days, 1), 366), top)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)